@@ -14,30 +14,39 @@ import json
 import logging
 import os
 import ipaddress
+import queue
 import re
 import secrets
 import sqlite3
+import threading
 import time
-from contextlib import asynccontextmanager
-from dataclasses import dataclass
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Iterable, Literal, Optional, Tuple
+from types import MappingProxyType
+from typing import Any, Iterable, Iterator, Literal, Mapping, NamedTuple, Optional, Tuple
 from urllib.parse import quote
 
 from fastapi import Body, FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, Response
+from fastapi.responses import (
+    FileResponse,
+    HTMLResponse,
+    JSONResponse,
+    ORJSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.staticfiles import StaticFiles
+import orjson
 from pydantic import BaseModel, Field
 
-from render import (
-    render_notes_table,
-    render_note_detail,
-    render_summary,
-    render_metrics,
-    render_scan_result,
-    render_no_ui,
-)
+# render は HTML 経路でしか使わないので、各ハンドラ内で遅延 import する
+# （JSON のみの CI 経路 /scan, /export/* では読み込まない）
 
 
 # ============================================================
@@ -53,7 +62,9 @@ logger = logging.getLogger(__name__)
 # 刺し①: CSPレポートのサンプリング用（ログ燃え防止）
 # 同一違反（blocked-uri, violated-directive）を60秒に1回だけログ出力
 # key: (blocked_uri, violated_directive), value: last_logged_timestamp
-_CSP_REPORT_SAMPLING: dict[tuple[str, str], float] = {}
+# 挿入順 = 最終ログ時刻順（OrderedDict の LRU）。上限到達時は最古を1件だけ捨てる
+_CSP_REPORT_SAMPLING: "OrderedDict[tuple[str, str], float]" = OrderedDict()
+_CSP_REPORT_SAMPLING_MAX = 1000
 
 # ============================================================
 # Config
@@ -63,7 +74,8 @@ APP_DIR = Path(__file__).resolve().parent
 DB_PATH = Path(os.getenv("DB_PATH", str(APP_DIR / "ledger.sqlite3")))
 
 # Auth / Mode (Settings: single source of truth)
-@dataclass
+# 起動時に1回だけ確定させる値なので frozen（実行中の書き換えを禁止）
+@dataclass(frozen=True, slots=True)
 class Settings:
     mode: Literal["local", "prod"]
     admin_password: str
@@ -74,6 +86,15 @@ class Settings:
     csp_mode: Literal["off", "report", "enforce"]
     csp_report_uri: str
     csp_use_reporting_api: bool  # 刺し①: report-to + Reporting-Endpoints を有効化
+    # Proxy: TRUSTED_PROXY_CIDRS を起動時に1回だけ parse（毎リクエスト ip_network() しない）
+    trusted_proxy_networks: tuple[ipaddress.IPv4Network | ipaddress.IPv6Network, ...] = ()
+    # 派生値（毎リクエストの encode / 比較を省く）
+    session_secret_bytes: bytes = field(init=False, repr=False)
+    is_prod: bool = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "session_secret_bytes", self.session_secret.encode("utf-8"))
+        object.__setattr__(self, "is_prod", self.mode == "prod")
 
 
 _SETTINGS: Optional[Settings] = None
@@ -155,6 +176,17 @@ def load_settings() -> Settings:
     # CSP_USE_REPORTING_API=1 で有効化（未設定時は旧式report-uriのみ）
     csp_use_reporting_api = (os.getenv("CSP_USE_REPORTING_API") or "").strip().lower() in {"1", "true", "yes"}
 
+    # Proxy: 不正な CIDR は従来どおり黙って無視する（起動は止めない）
+    trusted_proxy_networks = []
+    for c in os.getenv("TRUSTED_PROXY_CIDRS", "127.0.0.1/32,::1/128").split(","):
+        c = c.strip()
+        if not c:
+            continue
+        try:
+            trusted_proxy_networks.append(ipaddress.ip_network(c, strict=False))
+        except ValueError:
+            continue
+
     s = Settings(
         mode=mode,  # type: ignore[arg-type]
         admin_password=admin_password,
@@ -164,6 +196,7 @@ def load_settings() -> Settings:
         csp_mode=csp_mode,  # type: ignore[arg-type]
         csp_report_uri=csp_report_uri,
         csp_use_reporting_api=csp_use_reporting_api,
+        trusted_proxy_networks=tuple(trusted_proxy_networks),
     )
     return s
 
@@ -178,6 +211,7 @@ def init_settings() -> None:
     global _SETTINGS
     _SETTINGS = load_settings()
     # Note: init_db() is called separately in lifespan after P1 contract gate check
+    # （ここは env の検証だけで DB を開かない: 設定ミスは DB 作成前に fail-fast する）
 
 
 def check_p1_contract_gate():
@@ -238,10 +272,18 @@ DEFAULT_REPO_ROOT = APP_DIR.parent
 # 4) fallback: DEFAULT_REPO_ROOT (legacy compatibility)
 LEDGER_REPO_ROOT_ENV = "LEDGER_REPO_ROOT"
 
+# NOTE / DONE は別パターンで1行に2回 finditer する（1本の alternation にはしない）
+# - "NOTE(vNext):x,DONE(vNext):x" のように slug の \S+ に続けて書かれた DONE も拾う（1本だと slug に飲まれて消える）
+# - 1行内の hit 順は「NOTE 全部 → DONE 全部」（upsert_notes_bulk の採番順がこれに依存する）
 TAG_RE = re.compile(r"NOTE\(vNext\):\s*(\S+)", re.IGNORECASE)
 DONE_RE = re.compile(r"DONE\(vNext\):\s*(\S+)", re.IGNORECASE)
+_TAG_KINDS = (("note", TAG_RE), ("done", DONE_RE))
+# bytes 用の前段フィルタ（TAG_RE / DONE_RE の接頭辞だけ。ASCII のみなので bytes の IGNORECASE で同値）
+_TAG_PREFILTER_RE = re.compile(rb"(?:NOTE|DONE)\(vNext\):", re.IGNORECASE)
+# str.splitlines() が "\n" 以外に改行とみなす文字（これを含むファイルは splitlines で行を数える）
+_NON_LF_LINE_BREAKS = ("\r", "\v", "\f", "\x1c", "\x1d", "\x1e", "\x85", "\u2028", "\u2029")
 
-EXCLUDE_DIRS = {
+EXCLUDE_DIRS = frozenset({
     ".git",
     ".venv",
     "venv",
@@ -252,22 +294,26 @@ EXCLUDE_DIRS = {
     "node_modules",
     "dist",
     "build",
-}
+})
 
-SCAN_EXTS = {".py", ".md", ".ts", ".tsx", ".js", ".jsx"}
+SCAN_EXTS = frozenset({".py", ".md", ".ts", ".tsx", ".js", ".jsx"})
+
+# Scan: ファイル読み込みの並列度（I/O 待ちを重ねる目的。CPU 数より多めでよい）
+_SCAN_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+_SCAN_PARALLEL_MIN_FILES = 64
 
 ACTIVE_STATUSES = ("open", "doing", "parked")
 # render_summary は「順序付きの list[str]」が欲しい（UI表示順を固定する）
 ALLOWED_STATUS_ORDER: list[str] = ["open", "doing", "parked", "done", "stale"]
-# membership 判定用（速い）
-ALLOWED_STATUS = set(ALLOWED_STATUS_ORDER)
+# membership 判定用（速い）。定数なので frozenset（実行時に書き換えさせない）
+ALLOWED_STATUS = frozenset(ALLOWED_STATUS_ORDER)
 
 
 PRIORITY_RANGE = (1, 3)
 
 
 # Risk level: 2段階（high, critical）
-ALLOWED_RISK_LEVEL = {"high", "critical"}
+ALLOWED_RISK_LEVEL = frozenset({"high", "critical"})
 
 
 # ============================================================
@@ -300,23 +346,30 @@ def _is_trusted_proxy(request: Request) -> bool:
     if client_host in {"testclient", "testserver"}:
         return True
 
-    cidrs_raw = os.getenv("TRUSTED_PROXY_CIDRS", "127.0.0.1/32,::1/128")
-    cidrs = [c.strip() for c in cidrs_raw.split(",") if c.strip()]
-
     try:
         ip = ipaddress.ip_address(client_host)
     except ValueError:
         return False
 
-    for c in cidrs:
-        try:
-            if ip in ipaddress.ip_network(c, strict=False):
-                return True
-        except ValueError:
-            continue
-    return False
+    # CIDR は load_settings() で parse 済み（TRUSTED_PROXY_CIDRS）
+    return any(ip in net for net in get_settings().trusted_proxy_networks)
+
 
 
+# Forwarded / Host ヘッダ解析用（毎リクエストで re キャッシュを引かない）
+_FORWARDED_PROTO_RE = re.compile(r"proto=([^;,\s]+)")
+_FORWARDED_HOST_RE = re.compile(r"host=([^;,\s]+)")
+_SAFE_HOST_RE = re.compile(r"^[A-Za-z0-9\.\-:]+$")
+
+
+def _sanitize_host(h: str) -> str:
+    if not h:
+        return ""
+    # Allow only safe host characters (port included)
+    if _SAFE_HOST_RE.match(h):
+        return h
+    return ""
+
 
 def _xff_leftmost(request: Request) -> str:
     xff = request.headers.get("x-forwarded-for") or ""
@@ -334,7 +387,7 @@ def _is_https(request: Request) -> bool:
 
         forwarded = (request.headers.get("forwarded") or "").lower()
         # e.g. Forwarded: for=...;proto=https;host=...
-        m = re.search(r"proto=([^;,\s]+)", forwarded)
+        m = _FORWARDED_PROTO_RE.search(forwarded)
         if m:
             return m.group(1).strip() == "https"
 
@@ -362,7 +415,7 @@ def _get_external_origin(request: Request) -> str:
             proto = xf_proto
         else:
             forwarded = (request.headers.get("forwarded") or "").lower()
-            m = re.search(r"proto=([^;,\s]+)", forwarded)
+            m = _FORWARDED_PROTO_RE.search(forwarded)
             if m:
                 proto_candidate = m.group(1).strip()
                 if proto_candidate in {"https", "http"}:
@@ -374,34 +427,26 @@ def _get_external_origin(request: Request) -> str:
         proto = base_scheme if base_scheme in {"https", "http"} else "http"
 
     # Host: x-forwarded-host → forwarded → request.headers["host"] → request.base_url.hostname
-    def sanitize_host(h: str) -> str:
-        if not h:
-            return ""
-        # Allow only safe host characters (port included)
-        if re.match(r"^[A-Za-z0-9\.\-:]+$", h):
-            return h
-        return ""
-
     host: Optional[str] = None
 
     if trusted:
         xf_host = (request.headers.get("x-forwarded-host") or "").split(",")[0].strip()
-        xf_host_safe = sanitize_host(xf_host)
+        xf_host_safe = _sanitize_host(xf_host)
         if xf_host_safe:
             host = xf_host_safe
         else:
             forwarded = (request.headers.get("forwarded") or "").lower()
-            m = re.search(r"host=([^;,\s]+)", forwarded)
+            m = _FORWARDED_HOST_RE.search(forwarded)
             if m:
                 forwarded_host = m.group(1).strip()
-                forwarded_host_safe = sanitize_host(forwarded_host)
+                forwarded_host_safe = _sanitize_host(forwarded_host)
                 if forwarded_host_safe:
                     host = forwarded_host_safe
 
     # Fallback: request.headers["host"] or request.base_url.hostname
     if not host:
         host_candidate = request.headers.get("host") or str(request.base_url.hostname or "localhost")
-        host = sanitize_host(host_candidate) or "localhost"
+        host = _sanitize_host(host_candidate) or "localhost"
 
     return f"{proto}://{host}"
 
@@ -409,8 +454,10 @@ def _get_external_origin(request: Request) -> str:
 
 def _cookie_secure(request: Request) -> bool:
     """Return True if cookies should be marked Secure for this request."""
-    s = get_settings()
-    return (s.mode == "prod") and _is_https(request)
+    # local では proxy ヘッダの解釈自体が不要（_is_https を呼ばない）
+    if not get_settings().is_prod:
+        return False
+    return _is_https(request)
 
 
 def _is_local_host(request: Request) -> bool:
@@ -457,22 +504,49 @@ def _wants_html(request: Request) -> bool:
         - JSON body (Content-Type: application/json) => JSON (for API/test clients)
         - otherwise => HTML (for browser/htmx)
     """
-    accept = (request.headers.get("accept") or "").lower()
-    ct = (request.headers.get("content-type") or "").lower()
-
-    if ("text/html" in accept) or ("application/xhtml+xml" in accept):
-        return True
-    if "application/json" in accept:
-        return False
-    if (not accept) or ("*/*" in accept):
-        return "application/json" not in ct
-    return False
+    return _negotiate(request)[0]
 
 
 def _wants_json(request: Request) -> bool:
-    accept = (request.headers.get("accept") or "").lower()
-    ct = (request.headers.get("content-type") or "").lower()
-    return ("application/json" in accept) or ("application/json" in ct)
+    return _negotiate(request)[1]
+
+
+def _negotiate(request: Request) -> Tuple[bool, bool]:
+    """
+    (wants_html, wants_json) を1回のヘッダ解析で求め、request.state にメモする。
+    1リクエストで _wants_json（認証ゲート）→ _wants_html（応答形式）と続けて呼ばれるため。
+    """
+    cached = getattr(request.state, "negotiation", None)
+    if cached is not None:
+        return cached
+
+    cached = _negotiate_headers(request.headers.get("accept") or "", request.headers.get("content-type") or "")
+    request.state.negotiation = cached
+    return cached
+
+
+@lru_cache(maxsize=256)
+def _negotiate_headers(accept_raw: str, ct_raw: str) -> Tuple[bool, bool]:
+    """
+    Accept / Content-Type の生値 → (wants_html, wants_json)。純関数なのでヘッダ値でキャッシュする。
+    ブラウザ/クライアントが送る組み合わせは数種類なので、lower() と部分一致を毎回やり直さない
+    （上限付き LRU なので任意の値を送られても無制限には増えない）。
+    """
+    accept = accept_raw.lower()
+    ct = ct_raw.lower()
+    accept_json = "application/json" in accept
+    ct_json = "application/json" in ct
+
+    if ("text/html" in accept) or ("application/xhtml+xml" in accept):
+        wants_html = True
+    elif accept_json:
+        wants_html = False
+    elif (not accept) or ("*/*" in accept):
+        wants_html = not ct_json
+    else:
+        wants_html = False
+
+    return (wants_html, accept_json or ct_json)
 
 
 def _b64u(data: bytes) -> str:
@@ -485,34 +559,69 @@ def _b64u_dec(s: str) -> bytes:
 
 
 def _session_secret() -> bytes:
-    # Loaded and validated in init_settings()/lifespan.
-    return get_settings().session_secret.encode("utf-8")
+    # Loaded and validated in init_settings()/lifespan (encoded once there).
+    return get_settings().session_secret_bytes
+
+
+# HMAC の鍵スケジュール（ipad/opad の初期化）は secret ごとに1回だけ。以降は .copy() して使う
+@lru_cache(maxsize=8)
+def _hmac_template(secret: bytes) -> hmac.HMAC:
+    return hmac.new(secret, digestmod=hashlib.sha256)
+
+
+def _hmac_sha256(secret: bytes, msg: bytes) -> bytes:
+    h = _hmac_template(secret).copy()
+    h.update(msg)
+    return h.digest()
 
 
 def _sign_session(payload: dict[str, Any]) -> str:
-    raw = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
-    body = _b64u(raw)
-    sig = _b64u(hmac.new(_session_secret(), body.encode("ascii"), hashlib.sha256).digest())
+    raw = json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+    return _sign_session_cached(_session_secret(), raw)
+
+
+# payload は role 程度でほぼ固定なので、(secret, 正規化済み JSON) で署名結果をキャッシュ
+@lru_cache(maxsize=4096)
+def _sign_session_cached(secret: bytes, raw: str) -> str:
+    body = _b64u(raw.encode("utf-8"))
+    sig = _b64u(_hmac_sha256(secret, body.encode("ascii")))
     return f"{body}.{sig}"
 
 
-def _verify_session(token: str) -> Optional[dict[str, Any]]:
+def _verify_session(token: str) -> Optional[Mapping[str, Any]]:
+    return _verify_session_cached(_session_secret(), token)
+
+
+# 同じ cookie を毎リクエスト HMAC + json.loads しない（署名済み token は不変なので安全）
+# key に secret を含める: secret が変われば（再起動/テストの settings 差し替え）自然に別エントリ
+# 返り値は読み取り専用（キャッシュ共有の dict を呼び出し側が書き換えないように）
+@lru_cache(maxsize=4096)
+def _verify_session_cached(secret: bytes, token: str) -> Optional[Mapping[str, Any]]:
     try:
         body, sig = token.split(".", 1)
-        expected = _b64u(hmac.new(_session_secret(), body.encode("ascii"), hashlib.sha256).digest())
+        expected = _b64u(_hmac_sha256(secret, body.encode("ascii")))
         if not hmac.compare_digest(sig, expected):
             return None
         data = json.loads(_b64u_dec(body).decode("utf-8"))
         if not isinstance(data, dict):
             return None
-        return data
+        return MappingProxyType(data)
     except Exception:
         return None
 
 
-def _current_session(request: Request) -> Optional[dict[str, Any]]:
+_UNSET: Any = object()
+
+
+def _current_session(request: Request) -> Optional[Mapping[str, Any]]:
+    # 1リクエスト内では1回だけ解決する（auth_gate → endpoint で二重に検証しない）
+    cached = getattr(request.state, "session", _UNSET)
+    if cached is not _UNSET:
+        return cached
     token = request.cookies.get(SESSION_COOKIE)
-    return _verify_session(token) if token else None
+    session = _verify_session(token) if token else None
+    request.state.session = session
+    return session
 
 
 def _current_role(request: Request) -> str:
@@ -528,9 +637,19 @@ def _autologin_local(request: Request) -> Optional[dict[str, Any]]:
     return None
 
 
+def _resolve_session(request: Request) -> Optional[Mapping[str, Any]]:
+    """Cookie session, else local autologin. Memoized on request.state."""
+    cached = getattr(request.state, "auth_session", _UNSET)
+    if cached is not _UNSET:
+        return cached
+    session = _current_session(request) or _autologin_local(request)
+    request.state.auth_session = session
+    return session
+
+
 def _ensure_role(request: Request, allowed: set[str]) -> str:
     # Combined local + session check.
-    session = _current_session(request) or _autologin_local(request)
+    session = _resolve_session(request)
 
     if not session:
         raise HTTPException(status_code=401, detail="Authentication required")
@@ -559,8 +678,28 @@ def _clear_session(resp: Response) -> None:
     resp.delete_cookie(key=SESSION_COOKIE, httponly=True, samesite="lax")
 
 
+# CSRF token pool: os.urandom を1回でまとめて引き、64個ずつ払い出す
+# 各トークンは従来どおり 32 bytes（token_urlsafe(32) と同じエントロピー）
+# pid を記録して fork 後は捨てる（worker 間で同じトークンを配らない）
+_CSRF_TOKEN_BYTES = 32
+_CSRF_TOKEN_BATCH = 64
+_CSRF_TOKEN_POOL: list[str] = []
+_CSRF_TOKEN_POOL_PID = 0
+_CSRF_TOKEN_LOCK = threading.Lock()
+
+
 def _csrf_token() -> str:
-    return secrets.token_urlsafe(32)
+    global _CSRF_TOKEN_POOL_PID
+    with _CSRF_TOKEN_LOCK:
+        pid = os.getpid()
+        if pid != _CSRF_TOKEN_POOL_PID:
+            _CSRF_TOKEN_POOL.clear()
+            _CSRF_TOKEN_POOL_PID = pid
+        if not _CSRF_TOKEN_POOL:
+            n = _CSRF_TOKEN_BYTES
+            buf = os.urandom(n * _CSRF_TOKEN_BATCH)
+            _CSRF_TOKEN_POOL.extend(_b64u(buf[i : i + n]) for i in range(0, len(buf), n))
+        return _CSRF_TOKEN_POOL.pop()
 
 
 def _ensure_csrf_cookie(resp: Response, request: Request) -> None:
@@ -615,6 +754,21 @@ def _no_auth_json_exception() -> bool:
     return s.mode == "local" and s.allow_local_json_noauth
 
 
+def _json_noauth_allowed(request: Request) -> bool:
+    """
+    Endpoint gate: local JSON no-auth exception applies to this request
+    (_no_auth_json_exception() and localhost and Accept JSON).
+
+    結果は request.state にメモする（例外経路・再呼び出しでも localhost 判定 / XFF 解析をやり直さない）。
+    """
+    cached = getattr(request.state, "json_noauth", None)
+    if cached is not None:
+        return cached
+    allowed = _no_auth_json_exception() and _is_local_host(request) and _wants_json(request)
+    request.state.json_noauth = allowed
+    return allowed
+
+
 # ============================================================
 # Database
 # ============================================================
@@ -625,7 +779,9 @@ _PRAGMA_APPLIED_DBS = set()  # DB_PATH の文字列を記録（journal_mode用
 def db() -> sqlite3.Connection:
     """Return connection with Row factory (dict-like access)."""
     global _PRAGMA_APPLIED_DBS
-    con = sqlite3.connect(str(DB_PATH), check_same_thread=False)
+    # timeout=5.0（= busy_timeout 5000ms, sqlite3 の既定）を明示。statement cache は pool で使い回す前提で多めに
+    # uri=True: "file:...?mode=memory&cache=shared" も受ける（"file:" で始まらない普通のパスはそのままファイル名扱い）
+    con = sqlite3.connect(str(DB_PATH), timeout=5.0, check_same_thread=False, cached_statements=256, uri=True)
     con.row_factory = sqlite3.Row
     con.execute("PRAGMA foreign_keys = ON")
     
@@ -637,14 +793,83 @@ def db() -> sqlite3.Connection:
     
     # synchronous is per-connection, so set it every time
     con.execute("PRAGMA synchronous=NORMAL")
+    # 以下も接続ごと: temp table（scan の _fill_temp_keys）/ sort はメモリで、読み取りは mmap 経由
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA mmap_size=268435456")  # 256MB（上限。実際に map されるのは DB サイズ分）
+    con.execute("PRAGMA cache_size=-65536")  # 64MB（上限。ページは必要になった分だけ確保）
     
     return con
 
 
+# Connection pool（リクエスト経路用）
+# db() は毎回 connect + PRAGMA を実行するので、endpoint は db_conn() で使い回す
+# key: DB_PATH の文字列（テストで DB_PATH を差し替えても混線しない）
+_CONN_POOLS: dict[str, queue.LifoQueue] = {}
+_CONN_POOL_MAX_IDLE = 8
+
+
+@contextmanager
+def db_conn() -> Iterator[sqlite3.Connection]:
+    """
+    Borrow a pooled connection (PRAGMA 適用済み) for the duration of a with-block.
+
+    Semantics are the same as ``with db() as con``: commit on success,
+    rollback on exception. The connection is returned to the pool afterwards.
+    """
+    db_key = str(DB_PATH)
+    pool = _CONN_POOLS.get(db_key)
+    if pool is None:
+        pool = _CONN_POOLS.setdefault(db_key, queue.LifoQueue(maxsize=_CONN_POOL_MAX_IDLE))
+
+    try:
+        con = pool.get_nowait()
+    except queue.Empty:
+        con = db()
+
+    try:
+        with con:
+            yield con
+    finally:
+        if con.in_transaction:
+            # commit/rollback に失敗した接続は再利用しない
+            con.close()
+        else:
+            try:
+                pool.put_nowait(con)
+            except queue.Full:
+                _close_optimized(con)
+
+
+def _close_optimized(con: sqlite3.Connection) -> None:
+    # 接続を閉じる時に PRAGMA optimize（統計が古くなったテーブルだけ SQLite が必要な分 ANALYZE する）
+    try:
+        con.execute("PRAGMA optimize")
+    except sqlite3.Error:
+        pass
+    con.close()
+
+
+def close_pooled_connections() -> None:
+    """Close idle pooled connections (PRAGMA optimize 付き). Called on app shutdown."""
+    for pool in list(_CONN_POOLS.values()):
+        while True:
+            try:
+                con = pool.get_nowait()
+            except queue.Empty:
+                break
+            _close_optimized(con)
+
+
 def _ensure_column(con: sqlite3.Connection, table: str, col: str, ddl: str) -> None:
+    _ensure_columns(con, table, [(col, ddl)])
+
+
+def _ensure_columns(con: sqlite3.Connection, table: str, specs: list[Tuple[str, str]]) -> None:
+    # PRAGMA table_info はテーブルごとに1回だけ（列ごとに引き直さない）
     cols = {r[1] for r in con.execute(f"PRAGMA table_info({table})").fetchall()}
-    if col not in cols:
-        con.execute(f"ALTER TABLE {table} ADD COLUMN {col} {ddl}")
+    for col, ddl in specs:
+        if col not in cols:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {col} {ddl}")
 
 
 def init_db() -> None:
@@ -747,16 +972,22 @@ def init_db() -> None:
 
         # --- P1 backward-compat columns (do not refactor) ---
         # notes: required by tests/export contract
-        _ensure_column(con, "notes", "first_seen", "TEXT NOT NULL DEFAULT '1970-01-01T00:00:00Z'")
-        _ensure_column(con, "notes", "last_seen", "TEXT NOT NULL DEFAULT '1970-01-01T00:00:00Z'")
-        _ensure_column(con, "notes", "evidence_count", "INTEGER NOT NULL DEFAULT 0")
-        _ensure_column(con, "notes", "is_deleted", "INTEGER NOT NULL DEFAULT 0")
-        _ensure_column(con, "notes", "is_archived", "INTEGER NOT NULL DEFAULT 0")
+        _ensure_columns(con, "notes", [
+            ("first_seen", "TEXT NOT NULL DEFAULT '1970-01-01T00:00:00Z'"),
+            ("last_seen", "TEXT NOT NULL DEFAULT '1970-01-01T00:00:00Z'"),
+            ("evidence_count", "INTEGER NOT NULL DEFAULT 0"),
+            ("is_deleted", "INTEGER NOT NULL DEFAULT 0"),
+            ("is_archived", "INTEGER NOT NULL DEFAULT 0"),
+        ])
 
         # file_state: older DB safety (harmless if already present)
-        _ensure_column(con, "file_state", "mtime_ns", "INTEGER NOT NULL DEFAULT 0")
-        _ensure_column(con, "file_state", "size_bytes", "INTEGER NOT NULL DEFAULT 0")
-        _ensure_column(con, "file_state", "last_seen_at", "TEXT NOT NULL DEFAULT '1970-01-01T00:00:00Z'")
+        _ensure_columns(con, "file_state", [
+            ("mtime_ns", "INTEGER NOT NULL DEFAULT 0"),
+            ("size_bytes", "INTEGER NOT NULL DEFAULT 0"),
+            ("last_seen_at", "TEXT NOT NULL DEFAULT '1970-01-01T00:00:00Z'"),
+            # mtime だけ変わったファイルの中身比較用（未計算は NULL）
+            ("content_hash", "BLOB"),
+        ])
 
         # P1 Schema Version (Exclusive in P1 phase)
         now = datetime.now().isoformat(timespec="seconds")
@@ -770,7 +1001,72 @@ def init_db() -> None:
 
         # Create indexes after DDL/DML commit
         con.execute("CREATE INDEX IF NOT EXISTS idx_evidence_note ON evidence(note_id)")
+        # evidence の重複判定 (note_id, filepath, line_no) を DB 側で保証（INSERT OR IGNORE 用）
+        # 旧 DB に重複行が残っていると UNIQUE INDEX が作れないので、最古の1行だけ残して掃除してから作る
+        try:
+            con.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_evidence_uniq ON evidence(note_id, filepath, line_no)"
+            )
+        except sqlite3.IntegrityError:
+            con.execute("""
+                DELETE FROM evidence
+                WHERE id NOT IN (
+                    SELECT MIN(id) FROM evidence GROUP BY note_id, filepath, line_no
+                )
+            """)
+            con.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_evidence_uniq ON evidence(note_id, filepath, line_no)"
+            )
+            logger.warning("Removed duplicate evidence rows before creating idx_evidence_uniq")
+
+        # notes.evidence_count を evidence のトリガで維持する（一覧/エクスポートで毎回 COUNT しない）
+        # トリガが無かった DB（初回 / 旧 DB）は作成と同時に実数で埋め直す
+        has_count_triggers = con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_evidence_count_ins'"
+        ).fetchone()
+        con.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_evidence_count_ins AFTER INSERT ON evidence
+            BEGIN
+                UPDATE notes SET evidence_count = evidence_count + 1 WHERE id = NEW.note_id;
+            END
+        """)
+        con.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_evidence_count_del AFTER DELETE ON evidence
+            BEGIN
+                UPDATE notes SET evidence_count = evidence_count - 1 WHERE id = OLD.note_id;
+            END
+        """)
+        con.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_evidence_count_upd AFTER UPDATE OF note_id ON evidence
+            WHEN OLD.note_id IS NOT NEW.note_id
+            BEGIN
+                UPDATE notes SET evidence_count = evidence_count - 1 WHERE id = OLD.note_id;
+                UPDATE notes SET evidence_count = evidence_count + 1 WHERE id = NEW.note_id;
+            END
+        """)
+        if not has_count_triggers:
+            con.execute(
+                "UPDATE notes SET evidence_count = (SELECT COUNT(*) FROM evidence e WHERE e.note_id = notes.id)"
+            )
         con.execute("CREATE INDEX IF NOT EXISTS idx_events_note ON note_events(note_id)")
+        # /notes/table?comment=any|none の EXISTS 用（comment イベントだけの部分インデックス）
+        # status_change 等のイベント行を読まずに note_id だけで存在判定できる
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS idx_events_comment ON note_events(note_id) WHERE event_type = 'comment'"
+        )
+        # /export/summary の GROUP BY status と /notes/table の status/priority フィルタ用（covering）
+        # Note: is_deleted の部分インデックスにはしない（どちらのクエリも is_deleted で絞らないため使われない）
+        con.execute("CREATE INDEX IF NOT EXISTS idx_notes_status_priority ON notes(status, priority)")
+        # /notes/table の ORDER BY priority, updated_at DESC 用（フィルタ無しの一覧で temp B-tree sort をしない）
+        con.execute("CREATE INDEX IF NOT EXISTS idx_notes_priority_updated ON notes(priority, updated_at DESC)")
+        # /export/notes（既定: is_deleted=0 AND is_archived=0, ORDER BY updated_at DESC）用
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS idx_notes_export ON notes(is_deleted, is_archived, updated_at DESC)"
+        )
+
+        # planner 用の統計（sqlite_stat1）を起動時に更新。analysis_limit でテーブルごとの走査量を抑える
+        con.execute("PRAGMA analysis_limit=400")
+        con.execute("ANALYZE")
 
         con.commit()
 
@@ -829,21 +1125,56 @@ class Hit:
 
 
 def iter_source_files(root: Path) -> Iterable[Path]:
-    for p in root.rglob("*"):
-        if not p.is_file():
-            continue
-        if p.suffix not in SCAN_EXTS:
-            continue
-        if any(exc in p.parts for exc in EXCLUDE_DIRS):
-            continue
-        yield p
+    for entry in _iter_source_entries(root):
+        yield Path(entry.path)
 
 
-def _file_hash_key(p: Path) -> Tuple[int, int]:
+def _iter_source_entries(root: Path) -> Iterable[os.DirEntry]:
+    # os.scandir で走査（EXCLUDE_DIRS は中に入る前に刈る。node_modules 等を stat しない）
+    # symlink のディレクトリは辿らない（rglob と同じ。ループ防止）
+    # DirEntry をそのまま返す: diff scan は entry.stat() を使う（Windows では readdir の結果を再利用、追加の stat なし）
+    stack = [str(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in EXCLUDE_DIRS:
+                        stack.append(entry.path)
+                    continue
+                if os.path.splitext(entry.name)[1] not in SCAN_EXTS:
+                    continue
+                if not entry.is_file():
+                    continue
+                yield entry
+
+
+def _file_hash_key(p: Path | os.DirEntry) -> Tuple[int, int]:
+    # Path でも DirEntry でも可（DirEntry.stat() は結果をキャッシュする）
     st = p.stat()
     return (st.st_mtime_ns, st.st_size)
 
 
+def _file_content_hash(path: str | Path) -> Optional[bytes]:
+    """
+    Content fingerprint for the mtime-only-change tie-breaker (None if unreadable).
+
+    xxhash は依存に無いので stdlib の blake2b（8 bytes digest）を使う。衝突耐性より速度優先で十分。
+    """
+    try:
+        with open(path, "rb") as f:
+            return _content_digest(f.read())
+    except OSError:
+        return None
+
+
+def _content_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+
 def list_files_hashdiff(
     con: sqlite3.Connection,
     root: Path,
@@ -853,64 +1184,196 @@ def list_files_hashdiff(
     Return (files_to_scan, seen_paths_set).
 
     Only scan files that have changed (mtime_ns or size_bytes differ from DB).
+    mtime_ns だけ変わって size が同じファイルは content_hash で中身を確認し、同一なら再スキャンしない
+    （git checkout / rsync / format-on-save の touch だけで全文スキャンに戻らないように）。
+    スキャン対象にしたファイルの content_hash は、スキャンで読んだ bytes から
+    update_file_state_hashes() で入れ直す（ここで None のままの新規 / size 変更ファイルも含む）。
     """
     files_to_scan: list[Path] = []
     seen_paths: set[str] = set()
 
-    for p in iter_source_files(root):
-        rel = str(p.relative_to(root)).replace("\\", "/")
+    # file_state を1回で全件読み込む（ファイルごとの SELECT をやめる）
+    known: dict[str, Tuple[int, int, Optional[bytes]]] = {
+        r["filepath"]: (r["mtime_ns"], r["size_bytes"], r["content_hash"])
+        for r in con.execute("SELECT filepath, mtime_ns, size_bytes, content_hash FROM file_state")
+    }
+
+    changed_rows: list[Tuple[str, int, int, Optional[bytes], str]] = []
+
+    # rel は entry.path（str）から切り出す。Path を作るのはスキャン対象（変更あり）になった時だけ
+    root_prefix_len = len(os.path.join(str(root), ""))
+
+    for entry in _iter_source_entries(root):
+        rel = entry.path[root_prefix_len:].replace("\\", "/")
         seen_paths.add(rel)
 
-        mtime_ns, size = _file_hash_key(p)
+        mtime_ns, size = _file_hash_key(entry)
 
-        row = con.execute(
-            "SELECT mtime_ns, size_bytes FROM file_state WHERE filepath = ?",
-            (rel,),
-        ).fetchone()
+        prev = known.get(rel)
+        if prev is not None and prev[0] == mtime_ns and prev[1] == size:
+            continue
 
-        if row is None or row["mtime_ns"] != mtime_ns or row["size_bytes"] != size:
-            files_to_scan.append(p)
-            con.execute(
-                """
-                INSERT OR REPLACE INTO file_state (filepath, mtime_ns, size_bytes, last_seen_at)
-                VALUES (?, ?, ?, ?)
-                """,
-                (rel, mtime_ns, size, now),
-            )
+        content_hash: Optional[bytes] = None
+        if prev is not None and prev[1] == size:
+            # size が同じ時だけ中身を読む（size が違えば確実に変更なので読まない）
+            content_hash = _file_content_hash(entry.path)
+            if content_hash is not None and content_hash == prev[2]:
+                # 中身は同じ: mtime だけ更新してスキャン対象にはしない
+                changed_rows.append((rel, mtime_ns, size, content_hash, now))
+                continue
+
+        files_to_scan.append(Path(entry.path))
+        changed_rows.append((rel, mtime_ns, size, content_hash, now))
+
+    # 変更分はまとめて1回で upsert（呼び出し側のトランザクション内。commit は /scan の最後）
+    if changed_rows:
+        con.executemany(
+            """
+            INSERT OR REPLACE INTO file_state (filepath, mtime_ns, size_bytes, content_hash, last_seen_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            changed_rows,
+        )
 
     return files_to_scan, seen_paths
 
 
-def collect_hits_from_files(root: Path, files: list[Path]) -> list[Hit]:
+def update_file_state_hashes(con: sqlite3.Connection, content_hashes: Mapping[str, bytes]) -> None:
+    """
+    diff scan でスキャンしたファイルの content_hash を、スキャンで読んだ中身の digest で入れ直す。
+
+    新規 / size 変更のファイルも hash を持つので、次の mtime だけの変更（touch 等）で再スキャンしない。
+    """
+    if content_hashes:
+        con.executemany(
+            "UPDATE file_state SET content_hash = ? WHERE filepath = ?",
+            [(digest, rel) for rel, digest in content_hashes.items()],
+        )
+
+
+def collect_hits_from_files(
+    root: Path,
+    files: list[Path],
+    content_hashes: Optional[dict[str, bytes]] = None,
+) -> list[Hit]:
     """
     Scan files for NOTE(vNext) and DONE(vNext) tags.
     Return list of Hits.
+
+    content_hashes を渡すと、読めたファイルの content hash（rel path → digest）を詰めて返す。
+    スキャンで読んだ bytes から作るので、file_state 用にファイルを読み直さない。
     """
     hits: list[Hit] = []
-    for p in files:
-        try:
-            text = p.read_text(encoding="utf-8")
-        except (UnicodeDecodeError, PermissionError):
-            # Skip files that can't be read as UTF-8
-            continue
-        except Exception as e:
-            logger.warning(f"Failed to read {p}: {e}")
-            continue
+    want_hash = content_hashes is not None
+
+    def scan(p: Path) -> Tuple[list[Hit], Optional[bytes]]:
+        return _scan_file_hashed(root, p, want_hash)
+
+    def gather(results: Iterable[Tuple[list[Hit], Optional[bytes]]]) -> list[Hit]:
+        for p, (file_hits, digest) in zip(files, results):
+            hits.extend(file_hits)
+            if digest is not None and content_hashes is not None:
+                content_hashes[str(p.relative_to(root)).replace("\\", "/")] = digest
+        return hits
+
+    # 少数ファイル（diff scan の大半）はスレッド起動コストの方が高いので逐次
+    if len(files) < _SCAN_PARALLEL_MIN_FILES:
+        return gather(map(scan, files))
+
+    # 読み込み（I/O）を重ねるためにスレッドで並列化。map は入力順を保つので hits の順序は逐次と同じ
+    # DB 書き込みは呼び出し側（単一スレッド）のまま
+    with ThreadPoolExecutor(max_workers=_SCAN_MAX_WORKERS) as ex:
+        return gather(ex.map(scan, files, chunksize=32))
+
+
+def _scan_file(root: Path, p: Path) -> list[Hit]:
+    """Scan one file. Files without any NOTE/DONE tag are skipped before UTF-8 decode."""
+    return _scan_file_hashed(root, p, False)[0]
 
-        rel = str(p.relative_to(root)).replace("\\", "/")
 
+def _scan_file_hashed(root: Path, p: Path, want_hash: bool) -> Tuple[list[Hit], Optional[bytes]]:
+    """_scan_file + 読んだ bytes の content hash（want_hash=False / 読めなかった時は None）"""
+    try:
+        data = p.read_bytes()
+    except PermissionError:
+        return [], None
+    except Exception as e:
+        logger.warning(f"Failed to read {p}: {e}")
+        return [], None
+
+    digest = _content_digest(data) if want_hash else None
+
+    # 大半のファイルはタグを含まない: bytes のまま1回 search して、無ければ decode も行ループもしない
+    if not _TAG_PREFILTER_RE.search(data):
+        return [], digest
+
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        # Skip files that can't be read as UTF-8
+        return [], digest
+
+    rel = str(p.relative_to(root)).replace("\\", "/")
+
+    hits: list[Hit] = []
+    if any(ch in text for ch in _NON_LF_LINE_BREAKS):
+        # CRLF / CR / splitlines 特有の改行を含むファイルは行番号の数え方を splitlines に合わせる
         for i, line_text in enumerate(text.splitlines(), start=1):
-            for m in TAG_RE.finditer(line_text):
-                slug = m.group(1)
-                snippet = line_text.strip()[:200]
-                hits.append(Hit(kind="note", slug=slug, path=rel, line=i, snippet=snippet))
+            # 行単位の前段フィルタ: タグは必ず "...t):" / "...T):" を含む（"(vNext):" の末尾）
+            # IGNORECASE の正規表現は先頭リテラル最適化が効かないので、C の部分一致で先に落とす
+            if "t):" not in line_text and "T):" not in line_text:
+                continue
+            _collect_line_hits(hits, rel, i, line_text)
+        return hits, digest
+
+    # "\n" だけのファイル（大半）: splitlines で全行の str を作らず、候補行だけ切り出す
+    # 候補行 = "t):" / "T):" を含む行。行番号は直前の候補行からの "\n" の数で進める
+    line_starts: set[int] = set()
+    for needle in ("t):", "T):"):
+        i = text.find(needle)
+        while i != -1:
+            line_starts.add(text.rfind("\n", 0, i) + 1)
+            i = text.find(needle, i + 3)
+
+    line_no = 1
+    last = 0
+    for start in sorted(line_starts):
+        line_no += text.count("\n", last, start)
+        last = start
+        end = text.find("\n", start)
+        _collect_line_hits(hits, rel, line_no, text[start:] if end == -1 else text[start:end])
+    return hits, digest
+
+
+_SNIPPET_MAX = 200
+_SNIPPET_HEAD = 2 * _SNIPPET_MAX
 
-            for m in DONE_RE.finditer(line_text):
-                slug = m.group(1)
-                snippet = line_text.strip()[:200]
-                hits.append(Hit(kind="done", slug=slug, path=rel, line=i, snippet=snippet))
 
-    return hits
+def _snippet(line_text: str) -> str:
+    """
+    line_text.strip()[:200] と同じ結果を返す。
+
+    minified JS 等の巨大な行で行全体を strip() コピーしないよう、先頭 400 文字だけで確定できる時はそれで返す。
+    確定できない（先頭が空白だらけ / 末尾まで空白）時だけ全体を strip する。
+    """
+    if len(line_text) <= _SNIPPET_HEAD:
+        return line_text.strip()[:_SNIPPET_MAX]
+    head = line_text[:_SNIPPET_HEAD].lstrip()
+    # head の 200 文字目以降に非空白があれば、全体の rstrip は先頭 200 文字に影響しない
+    if len(head.rstrip()) >= _SNIPPET_MAX:
+        return head[:_SNIPPET_MAX]
+    return line_text.strip()[:_SNIPPET_MAX]
+
+
+def _collect_line_hits(hits: list[Hit], rel: str, line_no: int, line_text: str) -> None:
+    """Append NOTE/DONE hits found in one line (shared by both line-splitting paths)."""
+    snippet: Optional[str] = None
+    for kind, tag_re in _TAG_KINDS:
+        for m in tag_re.finditer(line_text):
+            if snippet is None:
+                # 同じ行の複数タグで strip/slice を繰り返さない（マッチが無い行では作らない）
+                snippet = _snippet(line_text)
+            hits.append(Hit(kind=kind, slug=m.group(1), path=rel, line=line_no, snippet=snippet))
 
 
 # ============================================================
@@ -971,6 +1434,62 @@ def upsert_note(con: sqlite3.Connection, slug: str, now: str) -> Tuple[int, bool
         return note_id, False
 
 
+def upsert_notes_bulk(
+    con: sqlite3.Connection,
+    slugs: Iterable[str],
+    now: str,
+) -> Tuple[dict[str, int], int]:
+    """
+    Batch version of upsert_note over all slugs seen in one scan.
+
+    Returns:
+        (slug -> note_id, revived_count)
+
+    P1 Contract (upsert_note と同じ):
+    - stale → open revive は slug ごとに1回だけ数える（status_change イベントも1件）
+    - 新規 slug は 'open' で作成し、created イベントを記録する
+    - 新規 note の id は slugs の初出順に採番（逐次版と同じ）
+    """
+    ordered = list(dict.fromkeys(slugs))
+    if not ordered:
+        return {}, 0
+
+    keys = _fill_temp_keys(con, "scan_hit_slugs", ordered)
+
+    # 既存分の revive は SQL 2文で（旧 status='stale' をイベントに残してから UPDATE）
+    revived_count = _transition_notes(con, "open", f"slug IN {keys} AND status = 'stale'", (), now)
+
+    ids: dict[str, int] = {
+        r["slug"]: r["id"] for r in con.execute(f"SELECT id, slug FROM notes WHERE slug IN {keys}")
+    }
+
+    missing = [s for s in ordered if s not in ids]
+    if missing:
+        con.executemany(
+            """
+            INSERT INTO notes (slug, status, priority, created_at, updated_at)
+            VALUES (?, 'open', NULL, ?, ?)
+            """,
+            ((s, now, now) for s in missing),
+        )
+        # executemany は RETURNING を返せないので、新規分の id は1回の SELECT で引き直す
+        new_ids = {
+            r["slug"]: r["id"]
+            for r in con.execute(f"SELECT id, slug FROM notes WHERE slug IN {keys}")
+            if r["slug"] not in ids
+        }
+        con.executemany(
+            """
+            INSERT INTO note_events (note_id, event_type, new_value, changed_at)
+            VALUES (?, 'created', 'open', ?)
+            """,
+            ((new_ids[s], now) for s in missing),
+        )
+        ids.update(new_ids)
+
+    return ids, revived_count
+
+
 def add_evidence(
     con: sqlite3.Connection,
     note_id: int,
@@ -989,22 +1508,86 @@ def add_evidence(
     - Duplicate check: (note_id, filepath, line_no)
     - Only add if not present
     """
-    exists = con.execute(
-        "SELECT 1 FROM evidence WHERE note_id = ? AND filepath = ? AND line_no = ?",
-        (note_id, filepath, line_no),
-    ).fetchone()
+    # 重複判定は idx_evidence_uniq に任せる（SELECT → INSERT の2往復を1回に）
+    cur = con.execute(
+        """
+        INSERT OR IGNORE INTO evidence (note_id, filepath, line_no, snippet, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (note_id, filepath, line_no, snippet, now),
+    )
+    return cur.rowcount == 1
 
-    if exists:
-        return False
 
-    con.execute(
+def add_evidence_many(
+    con: sqlite3.Connection,
+    items: Iterable[Tuple[int, str, int, str]],
+    now: str,
+) -> int:
+    """
+    Batch version of add_evidence: items are (note_id, filepath, line_no, snippet).
+
+    Returns:
+        Number of evidence rows inserted.
+
+    P1 Contract (add_evidence と同じ):
+    - Duplicate check: (note_id, filepath, line_no)（DB 既存分 + 同一バッチ内の重複）
+    - 判定は idx_evidence_uniq + INSERT OR IGNORE、executemany 1回（行ごとの SELECT なし）
+    """
+    # rowcount = 各 INSERT の changes() の合計（IGNORE 分は 0）。total_changes はトリガの UPDATE も数えるので使わない
+    cur = con.executemany(
         """
-        INSERT INTO evidence (note_id, filepath, line_no, snippet, created_at)
+        INSERT OR IGNORE INTO evidence (note_id, filepath, line_no, snippet, created_at)
         VALUES (?, ?, ?, ?, ?)
         """,
-        (note_id, filepath, line_no, snippet, now),
+        ((note_id, filepath, line_no, snippet, now) for note_id, filepath, line_no, snippet in items),
+    )
+    return max(cur.rowcount, 0)
+
+
+def _transition_notes(
+    con: sqlite3.Connection,
+    new_status: str,
+    where_sql: str,
+    params: tuple,
+    now: str,
+) -> int:
+    """
+    WHERE に一致する notes を new_status へ遷移させ、status_change イベントを記録する（SQLのみ、Python ループなし）。
+
+    SQLite の RETURNING は更新後の値しか返さない（old_value が取れない）ため、
+    同一トランザクション内で「INSERT ... SELECT（旧 status を記録）→ UPDATE」の順に実行する。
+    """
+    con.execute(
+        f"""
+        INSERT INTO note_events (note_id, event_type, old_value, new_value, changed_at)
+        SELECT id, 'status_change', status, ?, ? FROM notes WHERE {where_sql}
+        """,
+        (new_status, now, *params),
+    )
+    cur = con.execute(
+        f"UPDATE notes SET status = ?, updated_at = ? WHERE {where_sql}",
+        (new_status, now, *params),
     )
-    return True
+    return cur.rowcount
+
+
+# ACTIVE_STATUSES は定数なので SQL リテラルとして埋め込む
+_ACTIVE_STATUS_SQL = ",".join(f"'{s}'" for s in ACTIVE_STATUSES)
+
+
+def _fill_temp_keys(con: sqlite3.Connection, table: str, keys: Iterable[str]) -> str:
+    """
+    keys を接続ローカルの TEMP テーブルに詰め直し、サブクエリ文字列を返す。
+
+    巨大な IN (?,?,...) は SQLITE_MAX_VARIABLE_NUMBER に当たる/毎回 parse が重いので、
+    「IN (SELECT k FROM temp.<table>)」で引く。pool の接続で再利用されるので毎回 DELETE してから入れる。
+    table は呼び出し側の固定名のみ（ユーザー入力を渡さない）。
+    """
+    con.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (k TEXT PRIMARY KEY) WITHOUT ROWID")
+    con.execute(f"DELETE FROM temp.{table}")
+    con.executemany(f"INSERT OR IGNORE INTO temp.{table} (k) VALUES (?)", ((k,) for k in keys))
+    return f"(SELECT k FROM temp.{table})"
 
 
 def force_done(con: sqlite3.Connection, slugs: set[str], now: str) -> int:
@@ -1021,29 +1604,14 @@ def force_done(con: sqlite3.Connection, slugs: set[str], now: str) -> int:
     if not slugs:
         return 0
 
-    placeholders = ",".join("?" * len(slugs))
-    rows = con.execute(
-        f"SELECT id, slug, status FROM notes WHERE slug IN ({placeholders})",
-        tuple(slugs),
-    ).fetchall()
-
-    forced = 0
-    for row in rows:
-        if row["status"] in ACTIVE_STATUSES:
-            con.execute(
-                "UPDATE notes SET status = 'done', updated_at = ? WHERE id = ?",
-                (now, row["id"]),
-            )
-            con.execute(
-                """
-                INSERT INTO note_events (note_id, event_type, old_value, new_value, changed_at)
-                VALUES (?, 'status_change', ?, 'done', ?)
-                """,
-                (row["id"], row["status"], now),
-            )
-            forced += 1
-
-    return forced
+    done_keys = _fill_temp_keys(con, "scan_done_slugs", slugs)
+    return _transition_notes(
+        con,
+        "done",
+        f"slug IN {done_keys} AND status IN ({_ACTIVE_STATUS_SQL})",
+        (),
+        now,
+    )
 
 
 def mark_missing_as_stale(
@@ -1067,37 +1635,13 @@ def mark_missing_as_stale(
         return 0
 
     # Full scan: mark missing notes as stale.
-    active_cond = ",".join(f"'{s}'" for s in ACTIVE_STATUSES)
-
     if seen_slugs:
-        placeholders = ",".join("?" * len(seen_slugs))
-        rows = con.execute(
-            f"""
-            SELECT id, slug, status FROM notes
-            WHERE status IN ({active_cond})
-              AND slug NOT IN ({placeholders})
-            """,
-            tuple(seen_slugs),
-        ).fetchall()
+        seen_keys = _fill_temp_keys(con, "scan_seen_slugs", seen_slugs)
+        where_sql = f"status IN ({_ACTIVE_STATUS_SQL}) AND slug NOT IN {seen_keys}"
     else:
-        rows = con.execute(
-            f"SELECT id, slug, status FROM notes WHERE status IN ({active_cond})"
-        ).fetchall()
+        where_sql = f"status IN ({_ACTIVE_STATUS_SQL})"
 
-    for row in rows:
-        con.execute(
-            "UPDATE notes SET status = 'stale', updated_at = ? WHERE id = ?",
-            (now, row["id"]),
-        )
-        con.execute(
-            """
-            INSERT INTO note_events (note_id, event_type, old_value, new_value, changed_at)
-            VALUES (?, 'status_change', ?, 'stale', ?)
-            """,
-            (row["id"], row["status"], now),
-        )
-
-    return len(rows)
+    return _transition_notes(con, "stale", where_sql, (), now)
 
 
 def cleanup_orphan_file_state(con: sqlite3.Connection, seen_paths: set[str]) -> int:
@@ -1115,19 +1659,9 @@ def cleanup_orphan_file_state(con: sqlite3.Connection, seen_paths: set[str]) ->
         # If no files seen, don't delete anything (safety).
         return 0
 
-    placeholders = ",".join("?" * len(seen_paths))
-    orphans = con.execute(
-        f"SELECT filepath FROM file_state WHERE filepath NOT IN ({placeholders})",
-        tuple(seen_paths),
-    ).fetchall()
-
-    if orphans:
-        con.execute(
-            f"DELETE FROM file_state WHERE filepath NOT IN ({placeholders})",
-            tuple(seen_paths),
-        )
-
-    return len(orphans)
+    seen_keys = _fill_temp_keys(con, "scan_seen_paths", seen_paths)
+    cur = con.execute(f"DELETE FROM file_state WHERE filepath NOT IN {seen_keys}")
+    return cur.rowcount
 
 
 def set_last_scan_at(con: sqlite3.Connection, now: str) -> None:
@@ -1238,35 +1772,43 @@ def _build_csp_policy(settings: Settings) -> str:
 # FastAPI App
 # ============================================================
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+def _startup(fastapi_app: FastAPI) -> None:
     """
-    Startup/shutdown lifecycle.
-    
+    Startup 処理本体（lifespan から呼ぶ。テストは lifespan を回さずにこれを直接呼べる）
+
     P1 Contract Gate Order:
     1. Load settings (but don't init DB yet)
     2. Check P1 contract gate (fail fast if CI not verified in prod)
     3. Initialize database (only after gate passes)
-    
+
     P2.5: CSP policy pre-build
     4. Build CSP policy and store in app.state (startup確定、middleware高速化)
     """
     init_settings()
     check_p1_contract_gate()
     init_db()
-    
+
     # P2.5: CSPポリシーを起動時に構築（middleware で毎回 build しない）
     settings = get_settings()
-    app.state.csp_mode = settings.csp_mode
-    app.state.csp_policy = _build_csp_policy(settings) if settings.csp_mode != "off" else None
-    app.state.mode = settings.mode  # 刺し①: middleware内でget_settings()を呼ばない（例外時の地雷除去）
-    app.state.csp_use_reporting_api = settings.csp_use_reporting_api  # 刺し①: Reporting-Endpointsヘッダ用
-    app.state.csp_report_uri = settings.csp_report_uri  # 刺し①: Reporting-Endpointsヘッダ用
-    
+    fastapi_app.state.csp_mode = settings.csp_mode
+    fastapi_app.state.csp_policy = _build_csp_policy(settings) if settings.csp_mode != "off" else None
+    fastapi_app.state.mode = settings.mode  # 刺し①: middleware内でget_settings()を呼ばない（例外時の地雷除去）
+    fastapi_app.state.csp_use_reporting_api = settings.csp_use_reporting_api  # 刺し①: Reporting-Endpointsヘッダ用
+    fastapi_app.state.csp_report_uri = settings.csp_report_uri  # 刺し①: Reporting-Endpointsヘッダ用
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup/shutdown lifecycle（startup は _startup、shutdown は pool の後始末）"""
+    _startup(app)
+
     yield
 
+    close_pooled_connections()
 
-app = FastAPI(lifespan=lifespan)
+
+# dict を返す endpoint は orjson で直列化（stdlib json より速い。出力は同じ compact / UTF-8）
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # P2.5: CSP middleware (StaticFiles mount の前に追加)
 # 刺し⑤: このミドルウェアはセキュリティヘッダのみを扱う（責務固定）
@@ -1351,6 +1893,52 @@ async def add_security_headers(request: Request, call_next):
 # exception handler でも同じ関数を呼んで、契約を二重保証（契約駆動の思想）
 
 
+# 固定値のセキュリティヘッダ（全レスポンス共通）
+_STATIC_SECURITY_HEADERS = {
+    "X-Content-Type-Options": "nosniff",
+    "Referrer-Policy": "strict-origin-when-cross-origin",
+    "X-Frame-Options": "DENY",
+}
+_STATIC_SECURITY_RAW_HEADERS: Tuple[Tuple[bytes, bytes], ...] = tuple(
+    (k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in _STATIC_SECURITY_HEADERS.items()
+)
+
+
+@lru_cache(maxsize=8)
+def _security_header_plan(
+    csp_mode: str,
+    csp_policy: str,
+) -> Tuple[Tuple[Tuple[bytes, bytes], ...], Tuple[Tuple[bytes, bytes], ...], frozenset[bytes]]:
+    """
+    (常に上書きするヘッダ, 無ければ付けるヘッダ, 削除するヘッダ名) を raw header（小文字 bytes）で返す。
+    csp_mode / csp_policy は起動時に固定なので、実質1回だけ組み立てる。
+    """
+    ro = b"content-security-policy-report-only"
+    enforce = b"content-security-policy"
+    policy = csp_policy.encode("latin-1") if csp_policy else b""
+    if csp_mode == "report":
+        return _STATIC_SECURITY_RAW_HEADERS, ((ro, policy),), frozenset({enforce})
+    if csp_mode == "enforce":
+        return _STATIC_SECURITY_RAW_HEADERS, ((enforce, policy),), frozenset({ro})
+    return _STATIC_SECURITY_RAW_HEADERS, (), frozenset()
+
+
+@lru_cache(maxsize=64)
+def _reporting_headers(endpoint_abs: str) -> Tuple[Tuple[bytes, bytes], Tuple[bytes, bytes]]:
+    """
+    (Reporting-Endpoints, Report-To) の raw header（小文字 bytes）。
+    外部 origin（= endpoint_abs）ごとに固定なので、毎リクエスト json.dumps / encode しない。
+    origin は _sanitize_host 済みの値のみ。上限付き LRU なので Host を変えられても無制限には増えない。
+    Note: Settings に持たせないのは、絶対URLがリクエストの外部 origin（X-Forwarded-*）で変わるため
+    """
+    max_age = 3600
+    report_to = json.dumps({"group": "csp-endpoint", "max_age": max_age, "endpoints": [{"url": endpoint_abs}]})
+    return (
+        (b"reporting-endpoints", f'csp-endpoint="{endpoint_abs}"'.encode("latin-1")),
+        (b"report-to", report_to.encode("latin-1")),
+    )
+
+
 def _apply_security_headers_to_response(response: Response, request: Request) -> Response:
     """
     刺し③: セキュリティヘッダとキャッシュ制御を response に適用
@@ -1366,69 +1954,81 @@ def _apply_security_headers_to_response(response: Response, request: Request) ->
     csp_use_reporting_api = request.app.state.csp_use_reporting_api
     csp_report_uri = request.app.state.csp_report_uri
 
-    # CSPヘッダ付与
-    if csp_mode != "off":
-        if csp_mode == "report":
-            if "Content-Security-Policy-Report-Only" not in response.headers:
-                response.headers["Content-Security-Policy-Report-Only"] = csp_policy
-            if "Content-Security-Policy" in response.headers:
-                del response.headers["Content-Security-Policy"]
-        elif csp_mode == "enforce":
-            if "Content-Security-Policy" not in response.headers:
-                response.headers["Content-Security-Policy"] = csp_policy
-            if "Content-Security-Policy-Report-Only" in response.headers:
-                del response.headers["Content-Security-Policy-Report-Only"]
-
-        # Reporting-Endpoints / Report-To（観測期間のみ）
-        if csp_mode == "report" and csp_use_reporting_api and csp_report_uri:
-            external_origin = _get_external_origin(request)
-            endpoint_abs = external_origin + csp_report_uri
-
-            response.headers["Reporting-Endpoints"] = f'csp-endpoint="{endpoint_abs}"'
-
-            max_age = 3600
-            response.headers["Report-To"] = json.dumps(
-                {"group": "csp-endpoint", "max_age": max_age, "endpoints": [{"url": endpoint_abs}]}
-            )
-
-    # その他セキュリティヘッダ
-    response.headers["X-Content-Type-Options"] = "nosniff"
-    response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-    response.headers["X-Frame-Options"] = "DENY"
+    # raw_headers（bytes の list）を直接1パスで組み立てる
+    # MutableHeaders の __setitem__/__delitem__/in はキーごとに list を線形走査するため
+    set_pairs, default_pairs, delete_keys = _security_header_plan(csp_mode, csp_policy)
 
-    def _add_vary_accept(resp: Response) -> None:
-        """Vary を壊さずに Accept を追加する（例外経路も含めて統一保証）"""
-        vary = resp.headers.get("Vary", "")
-        parts = [p.strip() for p in vary.split(",") if p.strip()]
-        if not any(p.lower() == "accept" for p in parts):
-            parts.append("Accept")
-        resp.headers["Vary"] = ", ".join(parts)
+    extra: list[Tuple[bytes, bytes]] = []
+    # Reporting-Endpoints / Report-To（観測期間のみ）
+    if csp_mode == "report" and csp_use_reporting_api and csp_report_uri:
+        external_origin = _get_external_origin(request)
+        extra.extend(_reporting_headers(external_origin + csp_report_uri))
 
     # 刺し③: キャッシュ制御も統合（/ と /static/ui.js のみ）
+    # 分岐チェーンではなく、起動時に作った (exact, prefix) の表を1回引くだけ
     path = request.url.path
+    cache_control, vary_accept = _cache_rule(mode, path)
+    if cache_control:
+        extra.append((b"cache-control", cache_control.encode("latin-1")))
+
+    raw = response.raw_headers
+    present = {k for k, _ in raw}
+    # 上書き対象（set/extra）と削除対象が既にある時だけ作り直す（大半は素通り）
+    drop = delete_keys.union(k for k, _ in set_pairs).union(k for k, _ in extra)
+    if not present.isdisjoint(drop):
+        raw[:] = [(k, v) for k, v in raw if k not in drop]
+    raw.extend(set_pairs)
+    # CSP 本体は endpoint 側で個別に付けた値があればそれを優先（setdefault）
+    raw.extend(kv for kv in default_pairs if kv[0] not in present)
+    raw.extend(extra)
+
+    if vary_accept:
+        _add_vary_accept(response)
 
-    if path == "/":
-        # トップHTML（index.html/index.htmx）のキャッシュ制御
-        if mode == "local":
-            response.headers["Cache-Control"] = "no-store"
-        else:  # prod
-            response.headers["Cache-Control"] = "no-cache"
+    return response
 
-        # / は HTML/JSON の分岐がある
-        _add_vary_accept(response)
 
-    elif path == "/notes" or path.startswith("/notes/"):
-        # /notes 系も HTML/JSON の分岐がある（401/403/404 等の例外経路でも Vary を落とさない）
-        _add_vary_accept(response)
+def _add_vary_accept(resp: Response) -> None:
+    """Vary を壊さずに Accept を追加する（例外経路も含めて統一保証）"""
+    vary = resp.headers.get("Vary")
+    if not vary:
+        # 大半はここ（split/join 不要）
+        resp.headers["Vary"] = "Accept"
+        return
+    parts = [p.strip() for p in vary.split(",") if p.strip()]
+    if not any(p.lower() == "accept" for p in parts):
+        parts.append("Accept")
+    resp.headers["Vary"] = ", ".join(parts)
+
+
+# path → (Cache-Control, Vary: Accept を付けるか)
+# - /           : HTML/JSON 分岐あり。トップHTMLは local=no-store / prod=no-cache
+# - /notes 系   : HTML/JSON 分岐あり（401/403/404 等の例外経路でも Vary を落とさない）
+# - /static/ui.js : prod でも常に no-store（UI未反映の本命対策）
+# - その他静的  : local のみ no-store
+_CACHE_RULES: dict[str, Tuple[dict[str, Tuple[Optional[str], bool]], dict[str, Tuple[Optional[str], bool]]]] = {
+    "local": (
+        {"/": ("no-store", True), "/notes": (None, True), "/static/ui.js": ("no-store", False)},
+        {"/notes/": (None, True), "/static/": ("no-store", False)},
+    ),
+    "prod": (
+        {"/": ("no-cache", True), "/notes": (None, True), "/static/ui.js": ("no-store", False)},
+        {"/notes/": (None, True)},
+    ),
+}
+_NO_CACHE_RULE: Tuple[Optional[str], bool] = (None, False)
 
-    elif path == "/static/ui.js":
-        # ui.js は prod でも常に no-store（UI未反映の本命対策）
-        response.headers["Cache-Control"] = "no-store"
-    elif mode == "local" and path.startswith("/static/"):
-        # その他静的: local のみ no-store
-        response.headers["Cache-Control"] = "no-store"
 
-    return response
+def _cache_rule(mode: str, path: str) -> Tuple[Optional[str], bool]:
+    exact, prefix = _CACHE_RULES.get(mode, _CACHE_RULES["prod"])
+    rule = exact.get(path)
+    if rule is not None:
+        return rule
+    # 先頭セグメント（"/notes/", "/static/"）で1回だけ引く
+    cut = path.find("/", 1)
+    if cut > 0:
+        return prefix.get(path[: cut + 1], _NO_CACHE_RULE)
+    return _NO_CACHE_RULE
 
 
 @app.exception_handler(HTTPException)
@@ -1521,7 +2121,7 @@ def logout():
 
 @app.get("/auth/check")
 def check_auth(request: Request):
-    session = _current_session(request) or _autologin_local(request)
+    session = _resolve_session(request)
     if not session:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return {"role": session.get("role"), "auto": session.get("auto", False)}
@@ -1534,7 +2134,7 @@ def check_auth(request: Request):
 @app.get("/")
 def root(request: Request):
     # Allow JSON-only endpoints without auth (local convenience).
-    if _no_auth_json_exception() and _is_local_host(request) and _wants_json(request):
+    if _json_noauth_allowed(request):
         return {"ok": True, "mode": get_settings().mode}
 
     # Interactive browser: require auth.
@@ -1549,6 +2149,7 @@ def root(request: Request):
         _ensure_csrf_cookie(resp, request)
         return resp
     else:
+        from render import render_no_ui
         return HTMLResponse(render_no_ui())
 
 
@@ -1556,117 +2157,154 @@ def root(request: Request):
 # Notes API
 # ============================================================
 
+@lru_cache(maxsize=256)
+def _notes_table_sql(n_statuses: int, has_none: bool, n_nums: int, comment_mode: str, slug_only: bool = False) -> str:
+    """
+    /notes/table の SQL を組み立てる（形は引数だけで決まるのでキャッシュ。値は常に ? で渡す）。
+
+    n_statuses は ALLOWED_STATUS 以下、n_nums は PRIORITY_RANGE の幅以下に頭打ちなので、キャッシュは有限。
+    slug_only=True は ?fields=slug 用（WHERE / ORDER BY は同じで、SELECT だけ slug に絞る）。
+    """
+    where: list[str] = []
+
+    if n_statuses:
+        where.append(f"n.status IN ({_placeholders(n_statuses)})")
+
+    if has_none and n_nums:
+        where.append(f"(n.priority IS NULL OR n.priority IN ({_placeholders(n_nums)}))")
+    elif has_none:
+        where.append("n.priority IS NULL")
+    elif n_nums:
+        where.append(f"n.priority IN ({_placeholders(n_nums)})")
+
+    # 判定は note_events.event_type='comment' の存在（JOINせず EXISTS）
+    # EXISTS は idx_events_comment（部分インデックス）の1回の probe になる
+    if comment_mode == "any":
+        where.append(
+            "EXISTS (SELECT 1 FROM note_events ne WHERE ne.note_id = n.id AND ne.event_type = 'comment')"
+        )
+    elif comment_mode == "none":
+        where.append(
+            "NOT EXISTS (SELECT 1 FROM note_events ne WHERE ne.note_id = n.id AND ne.event_type = 'comment')"
+        )
+
+    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+
+    # 並び: priority NULL が先頭 → priority 昇順 → updated_at 降順（SQLite の ASC は NULL が先頭なので CASE 不要）
+    # evidence 件数は notes.evidence_count（evidence のトリガで維持）。JOIN/GROUP BY なしで idx_notes_priority_updated の順に読む
+    columns = "n.slug" if slug_only else """n.id, n.slug, n.status, n.priority, n.created_at, n.updated_at,
+                   n.evidence_count"""
+    return f"""
+            SELECT {columns}
+            FROM notes n
+            {where_sql}
+            ORDER BY n.priority ASC, n.updated_at DESC
+            """
+
+
+def _placeholders(n: int) -> str:
+    return ",".join("?" * n)
+
+
 @app.get("/notes/table")
 def notes_table(
     request: Request,
     status: Optional[str] = None,
     priority: Optional[str] = None,
     comment: Optional[str] = None,
+    fields: Optional[str] = None,
 ):
     # JSON convenience exception.
-    if not (_no_auth_json_exception() and _is_local_host(request) and _wants_json(request)):
+    if not (_json_noauth_allowed(request)):
         _ensure_role(request, {"admin", "dev"})
 
-    where: list[str] = []
+    # projection:
+    #   ?fields=slug -> JSON は {"slugs": [...]} だけ返す（HTML の表は全列が要るので無視）
+    slug_only = False
+    if fields is not None and fields.strip() != "":
+        if fields.strip().lower() != "slug":
+            raise HTTPException(status_code=400, detail="Invalid fields")
+        slug_only = not _wants_html(request)
+
     params: list[object] = []
 
+    n_statuses = 0
     if status:
-        statuses = [s.strip() for s in status.split(",") if s.strip()]
+        # 重複は除く（IN の結果は同じ。SQL キャッシュのキーを ALLOWED_STATUS の数で頭打ちにする）
+        statuses = list(dict.fromkeys(s.strip() for s in status.split(",") if s.strip()))
         if not statuses:
             raise HTTPException(status_code=400, detail="Invalid status filter")
         for s in statuses:
             if s not in ALLOWED_STATUS:
                 raise HTTPException(status_code=400, detail="Invalid status filter")
-        where.append("n.status IN (%s)" % ",".join(["?"] * len(statuses)))
+        n_statuses = len(statuses)
         params.extend(statuses)
 
     # priority filter:
     #   ?priority=none|1|2|3|none,1,2
     # none -> priority IS NULL
+    has_none = False
+    n_nums = 0
     if priority is not None and priority.strip() != "":
         parts = [p.strip() for p in priority.split(",") if p.strip()]
-        has_none = any(p.lower() == "none" for p in parts)
-        nums: list[int] = []
+        nums: set[int] = set()
         for p in parts:
             if p.lower() == "none":
+                has_none = True
                 continue
             if not p.isdigit():
                 raise HTTPException(status_code=400, detail="Invalid priority filter")
             v = int(p)
             if v < PRIORITY_RANGE[0] or v > PRIORITY_RANGE[1]:
                 raise HTTPException(status_code=400, detail="Invalid priority filter")
-            nums.append(v)
-        nums = sorted(set(nums))
-
-        if has_none and nums:
-            where.append("(n.priority IS NULL OR n.priority IN (%s))" % ",".join(["?"] * len(nums)))
-            params.extend(nums)
-        elif has_none:
-            where.append("n.priority IS NULL")
-        elif nums:
-            where.append("n.priority IN (%s)" % ",".join(["?"] * len(nums)))
-            params.extend(nums)
-        else:
+            nums.add(v)
+
+        if not has_none and not nums:
             # priority= (only commas/spaces) is treated as no filter; but priority=none must be explicit.
             raise HTTPException(status_code=400, detail="Invalid priority filter")
+        n_nums = len(nums)
+        params.extend(sorted(nums))
 
     # comment filter:
     #   ?comment=any|none
-    # 判定は note_events.event_type='comment' の存在（JOINせず EXISTS）
+    comment_mode = ""
     if comment is not None and comment.strip() != "":
-        v = comment.strip().lower()
-        if v == "any":
-            where.append(
-                "EXISTS (SELECT 1 FROM note_events ne WHERE ne.note_id = n.id AND ne.event_type = 'comment')"
-            )
-        elif v == "none":
-            where.append(
-                "NOT EXISTS (SELECT 1 FROM note_events ne WHERE ne.note_id = n.id AND ne.event_type = 'comment')"
-            )
-        else:
+        comment_mode = comment.strip().lower()
+        if comment_mode not in ("any", "none"):
             raise HTTPException(status_code=400, detail="Invalid comment filter")
 
-    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
-
-    with db() as con:
+    with db_conn() as con:
         rows = con.execute(
-            f"""
-            SELECT n.id, n.slug, n.status, n.priority, n.created_at, n.updated_at,
-                   COUNT(e.id) AS evidence_count
-            FROM notes n
-            LEFT JOIN evidence e ON n.id = e.note_id
-            {where_sql}
-            GROUP BY n.id
-            ORDER BY 
-                CASE WHEN n.priority IS NULL THEN 0 ELSE 1 END,
-                n.priority ASC,
-                n.updated_at DESC
-            """,
+            _notes_table_sql(n_statuses, has_none, n_nums, comment_mode, slug_only),
             tuple(params),
         ).fetchall()
 
+    if slug_only:
+        return ORJSONResponse({"slugs": [r[0] for r in rows]})
+
     notes = [dict(r) for r in rows]
 
     if _wants_html(request):
-        resp = HTMLResponse(render_notes_table(notes))
+        from render import NOTES_TABLE_CHUNK_ROWS, iter_notes_table, render_notes_table
+        if len(notes) > NOTES_TABLE_CHUNK_ROWS:
+            # 大きい表はページ全体の str を作らず chunk ごとに流す（小さい表は Content-Length 付きのまま）
+            resp = StreamingResponse(iter_notes_table(notes), media_type="text/html")
+        else:
+            resp = HTMLResponse(render_notes_table(notes))
         _ensure_csrf_cookie(resp, request)
-        # 刺し⑥: Vary: Accept を付与（HTML/JSON分岐によるキャッシュ事故防止）
-        resp.headers["Vary"] = "Accept"
         return resp
 
-    from fastapi.responses import JSONResponse
-    resp = JSONResponse({"notes": notes})
-    resp.headers["Vary"] = "Accept"
-    return resp
+    # 刺し⑥: Vary: Accept は _apply_security_headers_to_response（_CACHE_RULES の /notes 系）で一括付与
+    return ORJSONResponse({"notes": notes})
 
 
 @app.get("/notes/{slug}")
 def note_detail(request: Request, slug: str):
     # JSON convenience exception.
-    if not (_no_auth_json_exception() and _is_local_host(request) and _wants_json(request)):
+    if not (_json_noauth_allowed(request)):
         _ensure_role(request, {"admin", "dev"})
 
-    with db() as con:
+    with db_conn() as con:
         note_row = con.execute("SELECT * FROM notes WHERE slug = ?", (slug,)).fetchone()
         if not note_row:
             raise HTTPException(status_code=404, detail="Note not found")
@@ -1688,17 +2326,13 @@ def note_detail(request: Request, slug: str):
     events = [dict(r) for r in event_rows]
 
     if _wants_html(request):
+        from render import render_note_detail
         resp = HTMLResponse(render_note_detail(note, evidence, events))
         _ensure_csrf_cookie(resp, request)
-        # 刺し⑥: Vary: Accept を付与（HTML/JSON分岐によるキャッシュ事故防止）
-        resp.headers["Vary"] = "Accept"
         return resp
 
-    # 刺し⑥: JSON応答にもVary: Acceptを付与
-    from fastapi.responses import JSONResponse
-    resp = JSONResponse({"note": note, "evidence": evidence, "events": events})
-    resp.headers["Vary"] = "Accept"
-    return resp
+    # 刺し⑥: Vary: Accept は _apply_security_headers_to_response（_CACHE_RULES の /notes 系）で一括付与
+    return ORJSONResponse({"note": note, "evidence": evidence, "events": events})
 
 
 class NoteUpdateRequest(BaseModel):
@@ -1707,6 +2341,15 @@ class NoteUpdateRequest(BaseModel):
     comment: Optional[str] = None
 
 
+class _NoteDiff(NamedTuple):
+    """PATCH 前後の status / priority と、何か変わるか（comment 含む）"""
+    old_status: str
+    old_priority: Optional[int]
+    new_status: str
+    new_priority: Optional[int]
+    changed: bool
+
+
 # Contract (P1): empty-body PATCH returns 204
 #   (tests/test_patch_notes.py::test_patch_no_change_returns_204)
 # Contract (P1): comment-only PATCH returns 200
@@ -1720,7 +2363,7 @@ def update_note(request: Request, slug: str, req: NoteUpdateRequest):
     _verify_csrf_if_cookie_present(request)
 
     # JSON convenience exception.
-    if not (_no_auth_json_exception() and _is_local_host(request) and _wants_json(request)):
+    if not (_json_noauth_allowed(request)):
         _ensure_role(request, {"admin", "dev"})
 
     # 空PATCH（{}）は即204（P1 contract）
@@ -1743,7 +2386,8 @@ def update_note(request: Request, slug: str, req: NoteUpdateRequest):
 
     now = datetime.now().isoformat(timespec="seconds")
 
-    with db() as con:
+    with db_conn() as con:
+        # 404/400/no-op 判定は write lock なしの読み取りだけで済ませる（no-op PATCH で writer を塞がない）
         note_row = con.execute(
             "SELECT id, status, priority FROM notes WHERE slug = ?",
             (slug,),
@@ -1751,77 +2395,74 @@ def update_note(request: Request, slug: str, req: NoteUpdateRequest):
         if not note_row:
             raise HTTPException(status_code=404, detail="Note not found")
 
-        note_id = note_row["id"]
-        old_status = note_row["status"]
-        old_priority = note_row["priority"]
-
-        new_status = old_status
-        new_priority = old_priority
-
-        if status_provided:
-            if req.status not in ALLOWED_STATUS:
-                raise HTTPException(status_code=400, detail="Invalid status")
-            new_status = req.status
+        if status_provided and req.status not in ALLOWED_STATUS:
+            raise HTTPException(status_code=400, detail="Invalid status")
 
         if priority_provided:
             # priority は None 許可（クリア）
             if req.priority is not None:
                 if req.priority < PRIORITY_RANGE[0] or req.priority > PRIORITY_RANGE[1]:
                     raise HTTPException(status_code=400, detail=f"Invalid priority (must be {PRIORITY_RANGE[0]}-{PRIORITY_RANGE[1]})")
-            new_priority = req.priority
 
-        # 変更検出
-        changed = False
-        if new_status != old_status or new_priority != old_priority:
-            changed = True
-        if comment_provided and req.comment is not None:
-            changed = True
+        comment_changed = comment_provided and req.comment is not None
+
+        def _diff(row) -> _NoteDiff:
+            old_s, old_p = row["status"], row["priority"]
+            new_s = req.status if status_provided else old_s
+            new_p = req.priority if priority_provided else old_p
+            return _NoteDiff(old_s, old_p, new_s, new_p, new_s != old_s or new_p != old_p or comment_changed)
+
+        # 変更検出 → no-op は 204（監査ログ汚染防止）
+        if not _diff(note_row).changed:
+            return Response(status_code=204)
+
+        # 変更あり → ここで初めて write lock（deferred の read→write 昇格は WAL だと busy handler が効かず
+        # SQLITE_BUSY になるので BEGIN IMMEDIATE）。lock 前に読んだ値は古い可能性があるので取り直す
+        con.execute("BEGIN IMMEDIATE")
+        note_row = con.execute(
+            "SELECT id, status, priority FROM notes WHERE id = ?",
+            (note_row["id"],),
+        ).fetchone()
+        if not note_row:
+            raise HTTPException(status_code=404, detail="Note not found")
 
-        # no-op → 204（監査ログ汚染防止）
-        if not changed:
+        note_id = note_row["id"]
+        diff = _diff(note_row)
+        if not diff.changed:
             return Response(status_code=204)
+        old_status, old_priority = diff.old_status, diff.old_priority
+        new_status, new_priority = diff.new_status, diff.new_priority
 
         # 変更あり → UPDATE + events
-        con.execute(
-            "UPDATE notes SET status = ?, priority = ?, updated_at = ? WHERE id = ?",
+        # RETURNING * で更新後の行を受け取る（commit 後の SELECT * をやめる）
+        updated_row = con.execute(
+            "UPDATE notes SET status = ?, priority = ?, updated_at = ? WHERE id = ? RETURNING *",
             (new_status, new_priority, now, note_id),
-        )
+        ).fetchall()[0]
 
+        events: list[Tuple[int, str, Optional[str], Optional[str], str]] = []
         if new_status != old_status:
-            con.execute(
-                """
-                INSERT INTO note_events (note_id, event_type, old_value, new_value, changed_at)
-                VALUES (?, 'status_change', ?, ?, ?)
-                """,
-                (note_id, old_status, new_status, now),
-            )
-
+            events.append((note_id, "status_change", old_status, new_status, now))
         if new_priority != old_priority:
-            con.execute(
-                """
-                INSERT INTO note_events (note_id, event_type, old_value, new_value, changed_at)
-                VALUES (?, 'priority_change', ?, ?, ?)
-                """,
-                (
-                    note_id,
-                    None if old_priority is None else str(old_priority),
-                    None if new_priority is None else str(new_priority),
-                    now,
-                ),
-            )
-
+            events.append((
+                note_id,
+                "priority_change",
+                None if old_priority is None else str(old_priority),
+                None if new_priority is None else str(new_priority),
+                now,
+            ))
         if comment_provided and req.comment is not None:
-            con.execute(
-                """
-                INSERT INTO note_events (note_id, event_type, old_value, new_value, changed_at)
-                VALUES (?, 'comment', NULL, ?, ?)
-                """,
-                (note_id, req.comment, now),
-            )
+            events.append((note_id, "comment", None, req.comment, now))
 
-        con.commit()
+        con.executemany(
+            """
+            INSERT INTO note_events (note_id, event_type, old_value, new_value, changed_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            events,
+        )
 
-        updated_row = con.execute("SELECT * FROM notes WHERE id = ?", (note_id,)).fetchone()
+        con.commit()
 
     # Task 3: レスポンスをSuperset化（両契約テストを満たす）
     note = dict(updated_row)
@@ -1835,7 +2476,7 @@ def update_note(request: Request, slug: str, req: NoteUpdateRequest):
 @app.get("/export/notes")
 def export_notes(request: Request, include_deleted: int = 0, include_archived: int = 0):
     # JSON convenience exception.
-    if not (_no_auth_json_exception() and _is_local_host(request) and _wants_json(request)):
+    if not (_json_noauth_allowed(request)):
         _ensure_role(request, {"admin", "dev"})
 
     where = []
@@ -1845,29 +2486,47 @@ def export_notes(request: Request, include_deleted: int = 0, include_archived: i
         where.append("n.is_archived = 0")
     where_sql = ("WHERE " + " AND ".join(where)) if where else ""
 
-    with db() as con:
-        rows = con.execute(
-            f"""
+    sql = f"""
             SELECT n.id, n.slug, n.status, n.priority, n.created_at, n.updated_at,
-                   COUNT(e.id) as evidence_count
+                   n.evidence_count
             FROM notes n
-            LEFT JOIN evidence e ON n.id = e.note_id
             {where_sql}
-            GROUP BY n.id
             ORDER BY n.updated_at DESC
             """
-        ).fetchall()
 
-    return {"notes": [dict(r) for r in rows]}
+    # 既定（deleted/archived 除外）は idx_notes_export の順でそのまま読む（GROUP BY / ORDER BY の temp B-tree なし）
+    # 全件 fetchall + dict のリストを作らず、cursor から少しずつ JSON にして流す（ピークメモリを件数に比例させない）
+    # 出力バイト列は ORJSONResponse（{"notes": [...]}）と同じ
+    return StreamingResponse(_iter_notes_json(sql), media_type="application/json")
+
+
+_EXPORT_STREAM_BATCH = 500
+
+
+def _iter_notes_json(sql: str) -> Iterator[bytes]:
+    # sync generator は Starlette が threadpool で回すので、1行ずつではなく batch 単位で yield する
+    # 接続は generator の寿命の間だけ借りる（途中切断でも GeneratorExit で with を抜けて pool に戻る）
+    with db_conn() as con:
+        cur = con.execute(sql)
+        keys = [d[0] for d in cur.description]
+        prefix = b'{"notes":['
+        while True:
+            rows = cur.fetchmany(_EXPORT_STREAM_BATCH)
+            if not rows:
+                break
+            # batch を1回の orjson.dumps で配列化し、外側の [ ] だけ落として連結する
+            yield prefix + orjson.dumps([dict(zip(keys, r)) for r in rows])[1:-1]
+            prefix = b","
+        yield b"]}" if prefix == b"," else prefix + b"]}"
 
 
 @app.get("/export/summary")
 def export_summary(request: Request):
     # JSON convenience exception.
-    if not (_no_auth_json_exception() and _is_local_host(request) and _wants_json(request)):
+    if not (_json_noauth_allowed(request)):
         _ensure_role(request, {"admin", "dev"})
 
-    with db() as con:
+    with db_conn() as con:
         total = con.execute("SELECT COUNT(*) as cnt FROM notes").fetchone()["cnt"]
 
         rows = con.execute(
@@ -1889,6 +2548,7 @@ def export_summary(request: Request):
     }
 
     if _wants_html(request):
+        from render import render_summary
         resp = HTMLResponse(render_summary(data, allowed_statuses=ALLOWED_STATUS_ORDER))
 
         _ensure_csrf_cookie(resp, request)
@@ -1902,7 +2562,7 @@ def export_scan_history(limit: int = 50):
     if limit < 1 or limit > 2000:
         raise HTTPException(status_code=400, detail="limit must be 1..2000")
 
-    with db() as con:
+    with db_conn() as con:
         rows = con.execute(
             """
             SELECT id, scanned_at, scanned_root, full,
@@ -1918,6 +2578,44 @@ def export_scan_history(limit: int = 50):
     return {"recent": [dict(r) for r in rows]}
 
 
+# /export/metrics の集計列（キー順 = レスポンスの順）
+_METRICS_SUM_COLUMNS = (
+    "done_forced",
+    "stale_marked",
+    "revived_count",
+    "orphan_files_removed",
+    "evidence_added",
+    "files_scanned",
+    "slugs_found",
+)
+_METRICS_AGG_KEYS = ("runs", "full_runs", "diff_runs", *_METRICS_SUM_COLUMNS)
+
+
+def _metrics_agg_columns(prefix: str, cond: Optional[str]) -> str:
+    # 旧実装（集計クエリ2本）と同じ値: 対象0行なら runs=0 / full_runs・diff_runs=NULL / 他は 0
+    def v(expr: str) -> str:
+        return expr if cond is None else f"CASE WHEN {cond} THEN {expr} END"
+
+    cols = [
+        f"COUNT({v('1')}) AS {prefix}runs",
+        f"SUM({v('full = 1')}) AS {prefix}full_runs",
+        f"SUM({v('full = 0')}) AS {prefix}diff_runs",
+    ]
+    cols += [f"COALESCE(SUM({v(c)}), 0) AS {prefix}{c}" for c in _METRICS_SUM_COLUMNS]
+    return ",\n              ".join(cols)
+
+
+# recent = 新しい順に LIMIT ? 件。id の下限（cutoff）を1行サブクエリで1回だけ求めて条件にする
+_METRICS_AGG_SQL = f"""
+            SELECT
+              {_metrics_agg_columns("r_", "id >= c.cutoff")},
+              {_metrics_agg_columns("a_", None)},
+              (SELECT last_scan_at FROM scan_state WHERE id = 1) AS last_scan_at
+            FROM scan_log,
+                 (SELECT MIN(id) AS cutoff FROM (SELECT id FROM scan_log ORDER BY id DESC LIMIT ?)) AS c
+"""
+
+
 @app.get("/export/metrics")
 def export_metrics(request: Request, limit: int = 50):
     if limit < 1 or limit > 2000:
@@ -1925,7 +2623,7 @@ def export_metrics(request: Request, limit: int = 50):
 
     exported_at = datetime.now().isoformat(timespec="seconds")
 
-    with db() as con:
+    with db_conn() as con:
         recent = con.execute(
             """
             SELECT id, scanned_at, scanned_root, full,
@@ -1938,58 +2636,19 @@ def export_metrics(request: Request, limit: int = 50):
             (limit,),
         ).fetchall()
 
-        agg = con.execute(
-            """
-            SELECT
-              COUNT(*) as runs,
-              SUM(CASE WHEN full = 1 THEN 1 ELSE 0 END) as full_runs,
-              SUM(CASE WHEN full = 0 THEN 1 ELSE 0 END) as diff_runs,
-              COALESCE(SUM(done_forced), 0) as done_forced,
-              COALESCE(SUM(stale_marked), 0) as stale_marked,
-              COALESCE(SUM(revived_count), 0) as revived_count,
-              COALESCE(SUM(orphan_files_removed), 0) as orphan_files_removed,
-              COALESCE(SUM(evidence_added), 0) as evidence_added,
-              COALESCE(SUM(files_scanned), 0) as files_scanned,
-              COALESCE(SUM(slugs_found), 0) as slugs_found
-            FROM (
-              SELECT done_forced, stale_marked, revived_count, orphan_files_removed,
-                     evidence_added, files_scanned, slugs_found, full
-              FROM scan_log
-              ORDER BY id DESC
-              LIMIT ?
-            )
-            """,
-            (limit,),
-        ).fetchone()
-
-        agg_all = con.execute(
-            """
-            SELECT
-              COUNT(*) as runs,
-              SUM(CASE WHEN full = 1 THEN 1 ELSE 0 END) as full_runs,
-              SUM(CASE WHEN full = 0 THEN 1 ELSE 0 END) as diff_runs,
-              COALESCE(SUM(done_forced), 0) as done_forced,
-              COALESCE(SUM(stale_marked), 0) as stale_marked,
-              COALESCE(SUM(revived_count), 0) as revived_count,
-              COALESCE(SUM(orphan_files_removed), 0) as orphan_files_removed,
-              COALESCE(SUM(evidence_added), 0) as evidence_added,
-              COALESCE(SUM(files_scanned), 0) as files_scanned,
-              COALESCE(SUM(slugs_found), 0) as slugs_found
-            FROM scan_log
-            """
-        ).fetchone()
-
-        last_scan = con.execute("SELECT last_scan_at FROM scan_state WHERE id = 1").fetchone()[
-            "last_scan_at"
-        ]
+        # recent-N / all-time / last_scan_at を1文で（scan_log を1回だけ走査）
+        row = con.execute(_METRICS_AGG_SQL, (limit,)).fetchone()
+        agg = {k: row[f"r_{k}"] for k in _METRICS_AGG_KEYS}
+        agg_all = {k: row[f"a_{k}"] for k in _METRICS_AGG_KEYS}
+        last_scan = row["last_scan_at"]
 
     data = {
         "exported_at": exported_at,
         "last_scan_at": last_scan,
         "limit": limit,
         "recent": [dict(r) for r in recent],
-        "aggregate": dict(agg) if agg else {},
-        "aggregate_all": dict(agg_all) if agg_all else {},
+        "aggregate": agg,
+        "aggregate_all": agg_all,
         "resolved_root": str(resolve_root(None)),
         "root_resolution": {
             "order": [
@@ -2002,6 +2661,7 @@ def export_metrics(request: Request, limit: int = 50):
     }
 
     if _wants_html(request):
+        from render import render_metrics
         resp = HTMLResponse(render_metrics(data))
         _ensure_csrf_cookie(resp, request)
         return resp
@@ -2051,7 +2711,7 @@ def scan(
     # AUTHZ: /scan is a dangerous endpoint; CSRF does not protect no-cookie callers.
     # - local: allow JSON no-auth only for localhost scripts (ci_export 等)
     # - prod : ALWAYS require auth (no exceptions)
-    if not (_no_auth_json_exception() and _is_local_host(request) and _wants_json(request)):
+    if not (_json_noauth_allowed(request)):
         _ensure_role(request, {"admin", "dev"})
 
 
@@ -2070,26 +2730,40 @@ def scan(
     orphan_removed = 0
     revived_count = 0
 
-    with db() as con:
+    # diff scan だけ: スキャンで読んだ bytes の digest（file_state.content_hash 用）
+    content_hashes: Optional[dict[str, bytes]] = None
+
+    with db_conn() as con:
         if full:
             files = list(iter_source_files(root_path))
             seen_paths = {str(p.relative_to(root_path)).replace("\\", "/") for p in files}
         else:
             files, seen_paths = list_files_hashdiff(con, root=root_path, now=now)
+            content_hashes = {}
+
+        hits = collect_hits_from_files(root=root_path, files=files, content_hashes=content_hashes)
+
+        # ledger 書き込みは 1 トランザクションに束ねる。BEGIN IMMEDIATE で最初に write lock を取り、
+        # WAL で read→write 昇格時に SQLITE_BUSY（busy handler が効かない）で落ちるのを避ける。
+        # ファイル読み込み（上）はロック外。diff scan は file_state 更新で既に開始済みならそのまま続ける。
+        if not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")
 
-        hits = collect_hits_from_files(root=root_path, files=files)
+        if content_hashes is not None:
+            update_file_state_hashes(con, content_hashes)
 
         for h in hits:
             seen_slugs.add(h.slug)
             if h.kind == "done":
                 done_slugs.add(h.slug)
 
-            note_id, revived = upsert_note(con, h.slug, now)
-            if revived:
-                revived_count += 1
+        # notes は slug 単位でまとめて upsert（hit ごとの SELECT/INSERT 往復をやめる）
+        note_ids, revived_count = upsert_notes_bulk(con, (h.slug for h in hits), now)
 
-            if add_evidence(con, note_id, h.path, h.line, h.snippet, now):
-                evidence_added += 1
+        evidence_items = [(note_ids[h.slug], h.path, h.line, h.snippet) for h in hits]
+
+        # evidence は重複判定だけ行ごとに行い、INSERT はまとめて1回
+        evidence_added = add_evidence_many(con, evidence_items, now)
 
         done_forced = force_done(con, slugs=done_slugs, now=now)
 
@@ -2121,7 +2795,11 @@ def scan(
 
         con.commit()
 
+        # scan は notes/evidence/file_state を大きく動かすので、統計の更新が要るか SQLite に判断させる
+        con.execute("PRAGMA optimize")
+
     if _wants_html(request):
+        from render import render_scan_result
         html_out = render_scan_result(
             full=full,
             root_path=root_path,
@@ -2153,6 +2831,87 @@ def scan(
 # CSP Report Endpoint (P2.5)
 # ============================================================
 
+# CSP 報告として受け付ける media type（旧式 csp-report / Reporting API / 素の JSON）
+_CSP_REPORT_CONTENT_TYPES = ("application/json", "application/csp-report", "application/reports+json")
+_CSP_REPORT_MAX_BYTES = 32_768
+
+
+def _record_csp_report(body: Any) -> None:
+    """
+    decode 済みの CSP 報告を1件取り込む（形式判定 → サンプリング → ログ）。
+    HTTP の枠（Content-Type / サイズ / JSON decode）は csp_report 側で済ませてから呼ぶ。
+    例外は呼び出し側（csp_report）が握りつぶして 204 にする。
+    """
+    # 刺し②: 旧式csp-reportと新式Reporting API両対応
+    csp_report = None
+    
+    # 旧式: {"csp-report": {...}}
+    if "csp-report" in body:
+        csp_report = body["csp-report"]
+    # 新式Reporting API: {"reports": [{"type": "csp-violation", "body": {...}}]}
+    elif "reports" in body and isinstance(body["reports"], list) and len(body["reports"]) > 0:
+        first_report = body["reports"][0]
+        if isinstance(first_report, dict) and "body" in first_report:
+            csp_report = first_report["body"]
+    
+    if not csp_report:
+        # どちらの形式でもない: 静かに捨てる
+        return
+    
+    # 刺し①④: ログ汚染防止 - 運用で効く要点のみ抽出（ボディ全体はログしない）
+    # blocked-uri: 何がブロックされたか
+    # violated-directive: どのディレクティブ違反か
+    # effective-directive: 実際に適用されたディレクティブ（より具体的）
+    # source-file: 違反が発生したファイル（あれば）
+    blocked_uri = csp_report.get("blocked-uri") or csp_report.get("blockedURI") or "unknown"
+    violated_directive = csp_report.get("violated-directive") or csp_report.get("violatedDirective") or "unknown"
+    
+    # 刺しA: サンプリング（同一違反を60秒に1回だけログ出力）
+    # Report-Only運用で違反が多い期間、ログ課金/可観測性が死ぬのを防ぐ
+    # 
+    # ログ注入防止: blocked-uri/violated-directive から改行除去
+    blocked_uri_clean = blocked_uri.replace('\n', '').replace('\r', '')[:200]
+    violated_directive_clean = violated_directive.replace('\n', '').replace('\r', '')[:100]
+    
+    sampling_key = (blocked_uri_clean, violated_directive_clean)
+    now = time.time()
+    
+    last_logged = _CSP_REPORT_SAMPLING.get(sampling_key, 0.0)
+    
+    if now - last_logged < 60.0:
+        # 60秒以内に同じ違反をログ済み → 静かに捨てる（サンプリングでスキップ）
+        return
+    
+    # 刺しA: 辞書上限（1000件）- ユニーク違反が増殖してもメモリ安全
+    # LRU: 新規キーで上限に達していたら最古1件を捨てる（O(1)、sort しない）
+    if sampling_key not in _CSP_REPORT_SAMPLING and len(_CSP_REPORT_SAMPLING) >= _CSP_REPORT_SAMPLING_MAX:
+        _CSP_REPORT_SAMPLING.popitem(last=False)
+    
+    # サンプリング通過 → ログ出力してタイムスタンプ更新（末尾 = 最新）
+    _CSP_REPORT_SAMPLING[sampling_key] = now
+    _CSP_REPORT_SAMPLING.move_to_end(sampling_key)
+    
+    # ログに出す時だけ読む（サンプリングで捨てる報告では取り出さない）
+    effective_directive = csp_report.get("effective-directive") or csp_report.get("effectiveDirective") or ""
+    source_file = csp_report.get("source-file") or csp_report.get("sourceFile") or ""
+
+    log_parts = [
+        f"blocked-uri={blocked_uri[:200]}",
+        f"violated-directive={violated_directive[:100]}"
+    ]
+    if effective_directive:
+        log_parts.append(f"effective-directive={effective_directive[:100]}")
+    if source_file:
+        log_parts.append(f"source-file={source_file[:200]}")
+    
+    # 刺し①: prodはINFO、localはWARNING（本番のログ量を抑える）
+    settings = get_settings()
+    if settings.mode == "prod":
+        logger.info(f"CSP violation: {', '.join(log_parts)}")
+    else:
+        logger.warning(f"CSP violation: {', '.join(log_parts)}")
+
+
 @app.post("/__csp_report")
 async def csp_report(request: Request):
     """
@@ -2166,11 +2925,19 @@ async def csp_report(request: Request):
     try:
         # 刺し④: Content-Type チェック（DoS耐性・ログ汚染防止）
         # CSP報告っぽくないContent-Typeは即204で捨てる（パース不要）
-        content_type = request.headers.get("content-type", "").lower()
-        if content_type and not any(ct in content_type for ct in ["application/json", "application/csp-report", "application/reports+json"]):
+        # media type（; 以前）だけを小文字化して tuple の startswith 1回で判定
+        content_type = request.headers.get("content-type", "")
+        media_type = content_type.partition(";")[0].strip().lower()
+        if media_type and not media_type.startswith(_CSP_REPORT_CONTENT_TYPES):
             # CSP報告っぽくない: 静かに204（ログ汚染回避）
             return Response(status_code=204)
         
+        # 刺し④: 申告サイズが上限超なら body を読む前に捨てる（32KB をバッファしてから捨てない）
+        content_length = request.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > _CSP_REPORT_MAX_BYTES:
+            logger.warning(f"CSP report: oversized payload ({content_length} bytes, limit 32KB)")
+            return Response(status_code=204)
+        
         # 壊れた/非JSON/空bodyでも静かに204（ブラウザ実装の揺れに対応）
         body_bytes = await request.body()
         
@@ -2179,85 +2946,21 @@ async def csp_report(request: Request):
             return Response(status_code=204)
         
         # 刺し④: bodyサイズ上限（DoS耐性・メモリ汚染防止）
-        if len(body_bytes) > 32_768:  # 32KB上限
+        # Content-Length 無し（chunked）/ 申告と実体が違う場合もここで止める
+        if len(body_bytes) > _CSP_REPORT_MAX_BYTES:  # 32KB上限
             logger.warning(f"CSP report: oversized payload ({len(body_bytes)} bytes, limit 32KB)")
             return Response(status_code=204)
         
         # JSON decode試行（失敗しても204で飲み込む）
+        # json.loads は bytes を直接受け取れる（decode で str を1回作り直さない。不正 UTF-8 は UnicodeDecodeError）
         try:
-            body = json.loads(body_bytes.decode("utf-8"))
+            body = json.loads(body_bytes)
         except (json.JSONDecodeError, UnicodeDecodeError):
             # 壊れたpayload: ログに残して204
             logger.warning(f"CSP report: malformed payload (non-JSON or invalid encoding)")
             return Response(status_code=204)
         
-        # 刺し②: 旧式csp-reportと新式Reporting API両対応
-        csp_report = None
-        
-        # 旧式: {"csp-report": {...}}
-        if "csp-report" in body:
-            csp_report = body["csp-report"]
-        # 新式Reporting API: {"reports": [{"type": "csp-violation", "body": {...}}]}
-        elif "reports" in body and isinstance(body["reports"], list) and len(body["reports"]) > 0:
-            first_report = body["reports"][0]
-            if isinstance(first_report, dict) and "body" in first_report:
-                csp_report = first_report["body"]
-        
-        if not csp_report:
-            # どちらの形式でもない: 静かに204
-            return Response(status_code=204)
-        
-        # 刺し①④: ログ汚染防止 - 運用で効く要点のみ抽出（ボディ全体はログしない）
-        # blocked-uri: 何がブロックされたか
-        # violated-directive: どのディレクティブ違反か
-        # effective-directive: 実際に適用されたディレクティブ（より具体的）
-        # source-file: 違反が発生したファイル（あれば）
-        blocked_uri = csp_report.get("blocked-uri") or csp_report.get("blockedURI") or "unknown"
-        violated_directive = csp_report.get("violated-directive") or csp_report.get("violatedDirective") or "unknown"
-        effective_directive = csp_report.get("effective-directive") or csp_report.get("effectiveDirective") or ""
-        source_file = csp_report.get("source-file") or csp_report.get("sourceFile") or ""
-        
-        # 刺しA: サンプリング（同一違反を60秒に1回だけログ出力）
-        # Report-Only運用で違反が多い期間、ログ課金/可観測性が死ぬのを防ぐ
-        # 
-        # ログ注入防止: blocked-uri/violated-directive から改行除去
-        blocked_uri_clean = blocked_uri.replace('\n', '').replace('\r', '')[:200]
-        violated_directive_clean = violated_directive.replace('\n', '').replace('\r', '')[:100]
-        
-        sampling_key = (blocked_uri_clean, violated_directive_clean)
-        now = time.time()
-        
-        # 刺しA: 辞書上限（1000件）- ユニーク違反が増殖してもメモリ安全
-        if len(_CSP_REPORT_SAMPLING) >= 1000:
-            # 古いエントリを間引く（最古50%削除）
-            sorted_items = sorted(_CSP_REPORT_SAMPLING.items(), key=lambda x: x[1])
-            _CSP_REPORT_SAMPLING.clear()
-            _CSP_REPORT_SAMPLING.update(dict(sorted_items[500:]))
-        
-        last_logged = _CSP_REPORT_SAMPLING.get(sampling_key, 0.0)
-        
-        if now - last_logged < 60.0:
-            # 60秒以内に同じ違反をログ済み → 静かに204（サンプリングでスキップ）
-            return Response(status_code=204)
-        
-        # サンプリング通過 → ログ出力してタイムスタンプ更新
-        _CSP_REPORT_SAMPLING[sampling_key] = now
-        
-        log_parts = [
-            f"blocked-uri={blocked_uri[:200]}",
-            f"violated-directive={violated_directive[:100]}"
-        ]
-        if effective_directive:
-            log_parts.append(f"effective-directive={effective_directive[:100]}")
-        if source_file:
-            log_parts.append(f"source-file={source_file[:200]}")
-        
-        # 刺し①: prodはINFO、localはWARNING（本番のログ量を抑える）
-        settings = get_settings()
-        if settings.mode == "prod":
-            logger.info(f"CSP violation: {', '.join(log_parts)}")
-        else:
-            logger.warning(f"CSP violation: {', '.join(log_parts)}")
+        _record_csp_report(body)
     except Exception as e:
         # 予期しない例外: ログに残して204（レポート受信は止めない）
         logger.error(f"CSP report handler error: {e}")
@@ -1,53 +1,52 @@
 # render.py
 import html
-import json
+from functools import lru_cache
 from pathlib import Path
+from typing import Iterator
 from urllib.parse import quote
 
+import orjson
+
 
 def esc(s: str | None) -> str:
     """
     HTML escape for any user/DB-derived text inserted into HTML strings.
     Always escape (including quotes).
     """
-    return html.escape(s or "", quote=True)
+    # None / "" は html.escape を呼ばずに返す（空カラムが多い行で効く）
+    if not s:
+        return ""
+    # Note: str.translate(表) は CPython では html.escape（C実装の replace×5）より遅いので使わない
+    return html.escape(s, quote=True)
 
 
-def render_notes_table(notes: list[dict]) -> str:
-    rows = []
-    for n in notes:
-        status = esc(n["status"])
-        priority = n.get("priority")
-        priority_txt = "-" if priority is None else esc(str(priority))
-        # Contract (P1.5): slug may be Unicode; HTML uses esc() for display and quote(..., safe="") for href.
-        # Ref: tests/test_slug_unicode_ui.py::test_notes_table_html_renders_unicode_slug_and_encoded_href
-        slug_txt = esc(n["slug"])
-        slug_url = quote(n["slug"], safe="")
-        evidence_count = n["evidence_count"]
-
-        status_class = {
-            "open": "status-open",
-            "doing": "status-doing",
-            "parked": "status-parked",
-            "done": "status-done",
-            "stale": "status-stale",
-        }.get(status, "")
-
-        rows.append(
-            f"""
-            <tr>
-                <td><span class="{status_class}">{status}</span></td>
-                <td>{priority_txt}</td>
-                <td><a href="/notes/{slug_url}">{slug_txt}</a></td>
-                <td>{evidence_count}</td>
-            </tr>
-            """
-        )
+# event_type / status 遷移の old/new など種類の少ない値は escape 結果をキャッシュして使い回す
+# （snippet 等の一意な値に使うと miss ばかりで逆に遅いので、低カーディナリティの値だけ）
+_esc_token = lru_cache(maxsize=256)(esc)
 
-    if not rows:
-        rows.append("<tr><td colspan='4'>No notes found</td></tr>")
 
-    return f"""
+# status は固定の列挙値なので、CSS class と escape 済み表示文字列を起動時に1回だけ作る
+_STATUS_CLASS = {
+    "open": "status-open",
+    "doing": "status-doing",
+    "parked": "status-parked",
+    "done": "status-done",
+    "stale": "status-stale",
+}
+_ESCAPED_STATUS = {s: esc(s) for s in _STATUS_CLASS}
+# notes table の status セルは5種類しかないので、行ごとに組み立てず完成形を引く
+_STATUS_CELL = {s: f'<span class="{c}">{_ESCAPED_STATUS[s]}</span>' for s, c in _STATUS_CLASS.items()}
+# priority / evidence_count は小さい int がほとんど。str() + esc() を行ごとに回さず表引きにする（範囲外は従来通り）
+_SMALL_INT_TXT = {i: str(i) for i in range(256)}
+
+
+@lru_cache(maxsize=4096)
+def _slug_link(slug: str) -> str:
+    """slug の <a> セル丸ごと（href は quote 済み, 表示は esc 済み） — quote() は純Python実装で行ごとに呼ぶと一番重い"""
+    return f'<a href="/notes/{quote(slug, safe="")}">{esc(slug)}</a>'
+
+
+_NOTES_TABLE_HEAD = """
     <!DOCTYPE html>
     <html>
     <head><title>Notes</title></head>
@@ -63,61 +62,89 @@ def render_notes_table(notes: list[dict]) -> str:
             </tr>
         </thead>
         <tbody>
-            {"".join(rows)}
+            """
+_NOTES_TABLE_TAIL = """
         </tbody>
     </table>
     </body>
     </html>
     """
 
+# iter_notes_table が1回に yield する行数（StreamingResponse の chunk 単位）
+NOTES_TABLE_CHUNK_ROWS = 500
+
+
+def iter_notes_table(notes: list[dict], chunk_rows: int = NOTES_TABLE_CHUNK_ROWS) -> Iterator[str]:
+    """
+    render_notes_table と同じ HTML を head / 行 chunk / tail に分けて返す。
+    大きい表はページ全体の文字列を作らずに StreamingResponse で流せる。
+    """
+    # Note: Jinja2 等のテンプレートエンジンは入れない。f-string は import 時にバイトコード化済みなので、
+    # 行ループで効くのは quote()/esc() の呼び出し回数の方（slug 単位でキャッシュする）
+    # 行は断片を list に積んで chunk ごとに1回だけ join（行ごとのインデント付き中間文字列を作らない）
+    yield _NOTES_TABLE_HEAD
+
+    if not notes:
+        yield "<tr><td colspan='4'>No notes found</td></tr>"
+
+    for i in range(0, len(notes), chunk_rows):
+        rows: list[str] = []
+        extend = rows.extend
+        for n in notes[i:i + chunk_rows]:
+            status_cell = _STATUS_CELL.get(n["status"]) or f'<span class="">{esc(n["status"])}</span>'
+            priority = n.get("priority")
+            priority_txt = "-" if priority is None else (_SMALL_INT_TXT.get(priority) or esc(str(priority)))
+            # Contract (P1.5): slug may be Unicode; HTML uses esc() for display and quote(..., safe="") for href.
+            # Ref: tests/test_slug_unicode_ui.py::test_notes_table_html_renders_unicode_slug_and_encoded_href
+            slug_link = _slug_link(n["slug"])
+            evidence_count = n["evidence_count"]
+
+            extend((
+                "<tr><td>", status_cell,
+                "</td><td>", priority_txt,
+                "</td><td>", slug_link,
+                "</td><td>", _SMALL_INT_TXT.get(evidence_count) or str(evidence_count),
+                "</td></tr>\n",
+            ))
+        yield "".join(rows)
+
+    yield _NOTES_TABLE_TAIL
+
+
+def render_notes_table(notes: list[dict]) -> str:
+    return "".join(iter_notes_table(notes))
+
+
+def _evidence_row(e: dict) -> str:
+    return (
+        f"<tr><td>{esc(e['filepath'])}</td><td>{e['line_no']}</td>"
+        f"<td>{esc(e['snippet'])}</td><td>{esc(e['created_at'])}</td></tr>\n"
+    )
+
+
+def _event_row(ev: dict) -> str:
+    event_type = ev["event_type"]
+    # comment の本文は一意な自由文なのでキャッシュしない
+    esc_value = esc if event_type == "comment" else _esc_token
+    old_value = esc_value(ev["old_value"]) if ev["old_value"] else "-"
+    new_value = esc_value(ev["new_value"]) if ev["new_value"] else "-"
+    return (
+        f"<tr><td>{_esc_token(event_type)}</td><td>{old_value}</td>"
+        f"<td>{new_value}</td><td>{esc(ev['changed_at'])}</td></tr>\n"
+    )
+
 
 def render_note_detail(note: dict, evidence: list[dict], events: list[dict]) -> str:
     slug = esc(note["slug"])
-    status = esc(note["status"])
+    status = _ESCAPED_STATUS.get(note["status"]) or esc(note["status"])
     p = note.get("priority")
     priority = "-" if p is None else esc(str(p))
     created = esc(note["created_at"])
     updated = esc(note["updated_at"])
 
-    evidence_rows = []
-    for e in evidence:
-        filepath = esc(e["filepath"])
-        line_no = e["line_no"]
-        snippet = esc(e["snippet"])
-        created_at = esc(e["created_at"])
-        evidence_rows.append(
-            f"""
-            <tr>
-                <td>{filepath}</td>
-                <td>{line_no}</td>
-                <td>{snippet}</td>
-                <td>{created_at}</td>
-            </tr>
-            """
-        )
-
-    if not evidence_rows:
-        evidence_rows.append("<tr><td colspan='4'>No evidence</td></tr>")
-
-    event_rows = []
-    for ev in events:
-        event_type = esc(ev["event_type"])
-        old_value = esc(ev["old_value"]) if ev["old_value"] else "-"
-        new_value = esc(ev["new_value"]) if ev["new_value"] else "-"
-        changed_at = esc(ev["changed_at"])
-        event_rows.append(
-            f"""
-            <tr>
-                <td>{event_type}</td>
-                <td>{old_value}</td>
-                <td>{new_value}</td>
-                <td>{changed_at}</td>
-            </tr>
-            """
-        )
-
-    if not event_rows:
-        event_rows.append("<tr><td colspan='4'>No events</td></tr>")
+    # 行ループは map に任せて join 1回（notes table と同じくインデント無しの1行 <tr>）
+    evidence_body = "".join(map(_evidence_row, evidence)) or "<tr><td colspan='4'>No evidence</td></tr>"
+    event_body = "".join(map(_event_row, events)) or "<tr><td colspan='4'>No events</td></tr>"
 
     return f"""
     <!DOCTYPE html>
@@ -141,7 +168,7 @@ def render_note_detail(note: dict, evidence: list[dict], events: list[dict]) ->
             </tr>
         </thead>
         <tbody>
-            {"".join(evidence_rows)}
+            {evidence_body}
         </tbody>
     </table>
 
@@ -156,7 +183,7 @@ def render_note_detail(note: dict, evidence: list[dict], events: list[dict]) ->
             </tr>
         </thead>
         <tbody>
-            {"".join(event_rows)}
+            {event_body}
         </tbody>
     </table>
 
@@ -167,13 +194,22 @@ def render_note_detail(note: dict, evidence: list[dict], events: list[dict]) ->
 
 
 def render_summary(data: dict, allowed_statuses: list[str]) -> str:
-    total = data["total"]
+    # 出力は (total, last_scan_at, 件数) だけで決まり scan の間は変わらないので、値そのものをキーにキャッシュ
+    # （キーが中身なので scan 側からの invalidate は不要）
     by_status = data["by_status"]
-    last_scan = esc(data["last_scan_at"]) if data["last_scan_at"] else "Never"
+    return _render_summary_cached(
+        data["total"],
+        data["last_scan_at"],
+        tuple((s, by_status.get(s, 0)) for s in allowed_statuses),
+    )
+
+
+@lru_cache(maxsize=64)
+def _render_summary_cached(total: int, last_scan_at: str | None, status_counts: tuple[tuple[str, int], ...]) -> str:
+    last_scan = esc(last_scan_at) if last_scan_at else "Never"
 
     status_rows = []
-    for status in allowed_statuses:
-        count = by_status.get(status, 0)
+    for status, count in status_counts:
         status_rows.append(f"<tr><td>{status}</td><td>{count}</td></tr>")
 
     return f"""
@@ -199,6 +235,11 @@ def render_summary(data: dict, allowed_statuses: list[str]) -> str:
     """
 
 
+def _pretty_json(obj: dict) -> str:
+    # json.dumps(indent=2) と同じ整形（OPT_INDENT_2）。<pre> の本文なので & < > だけ escape（JSON の " はそのまま見せる）
+    return html.escape(orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode(), quote=False)
+
+
 def render_metrics(data: dict) -> str:
     exported_at = esc(data["exported_at"])
     last_scan = esc(data["last_scan_at"]) if data["last_scan_at"] else "Never"
@@ -218,10 +259,10 @@ def render_metrics(data: dict) -> str:
     <p><strong>Limit:</strong> {limit}</p>
 
     <h2>Aggregate (recent {limit})</h2>
-    <pre>{json.dumps(agg, indent=2)}</pre>
+    <pre>{_pretty_json(agg)}</pre>
 
     <h2>Aggregate (all time)</h2>
-    <pre>{json.dumps(agg_all, indent=2)}</pre>
+    <pre>{_pretty_json(agg_all)}</pre>
     </body>
     </html>
     """
@@ -1,12 +1,40 @@
 # root/vnext-ledger/tests/conftest.py
 
+import functools
 import os
+import sqlite3
+import uuid
 from pathlib import Path
+from typing import Any, Iterable
 
+import httpx
+import orjson
 import pytest
 import app
-from tests.helpers.auth import AuthClient
-from app import db
+from tests.helpers.auth import AuthClient, make_test_session
+from app import db_conn
+
+
+_httpx_response_json = httpx.Response.json
+
+
+def _orjson_response_json(self: httpx.Response, **kwargs: Any) -> Any:
+    # app は orjson で返しているので読む側も orjson（stdlib json.loads より速い）
+    # kwargs 付きの呼び出しや BOM 付き等の非 UTF-8 body は元の実装に任せる
+    if kwargs:
+        return _httpx_response_json(self, **kwargs)
+    try:
+        return orjson.loads(self.content)
+    except orjson.JSONDecodeError:
+        return _httpx_response_json(self)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _orjson_responses():
+    """TestClient の r.json() を session 全体で orjson に差し替える"""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(httpx.Response, "json", _orjson_response_json)
+        yield
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -24,12 +52,13 @@ def _load_settings_for_tests(tmp_path_factory):
         db_path = tmp_dir / "ledger.sqlite3"
 
         os.environ["DB_PATH"] = str(db_path)
-        app.DB_PATH = Path(os.environ["DB_PATH"])
+        app.DB_PATH = db_path
 
     else:
         # Isolation OFF...
-        if "DB_PATH" in os.environ and os.environ["DB_PATH"].strip():
-            app.DB_PATH = Path(os.environ["DB_PATH"])
+        env_db_path = os.environ.get("DB_PATH", "").strip()
+        if env_db_path:
+            app.DB_PATH = Path(env_db_path)
             app.DB_PATH.parent.mkdir(parents=True, exist_ok=True)
         # DB_PATH が無ければ app.DB_PATH をそのまま使う
 
@@ -51,48 +80,121 @@ def _load_settings_for_tests(tmp_path_factory):
     yield
 
 
+# seed 値（slug は呼び出し側で差し込む。notes に存在する列だけ使う）
+_SEED_NOTE_DEFAULTS = {
+    "slug": None,
+    "status": "open",
+    "first_seen": "1970-01-01T00:00:00Z",
+    "last_seen": "1970-01-01T00:00:00Z",
+    "created_at": "1970-01-01T00:00:00Z",
+    "updated_at": "1970-01-01T00:00:00Z",
+    "is_deleted": 0,
+    "is_archived": 0,
+    "title": "test note",
+}
+
+
+@functools.lru_cache(maxsize=8)
+def _seed_note_sql(db_path: str) -> tuple[str, tuple[str, ...]]:
+    """DB（パス）ごとに notes の列を1回だけ調べ、seed 用の INSERT と列順を返す"""
+    with db_conn() as con:
+        colset = {r[1] for r in con.execute("PRAGMA table_info(notes)").fetchall()}
+
+    cols = tuple(c for c in _SEED_NOTE_DEFAULTS if c in colset)
+    cols_sql = ", ".join(cols)
+    qs_sql = ", ".join(["?"] * len(cols))
+    return f"INSERT OR IGNORE INTO notes ({cols_sql}) VALUES ({qs_sql})", cols
+
+
+def _ensure_notes_exist(slugs: Iterable[str] = ("test",)) -> None:
+    """複数 slug の seed は executemany で1トランザクションにまとめる"""
+    sql, cols = _seed_note_sql(str(app.DB_PATH))
+    rows = [tuple(slug if c == "slug" else _SEED_NOTE_DEFAULTS[c] for c in cols) for slug in slugs]
+    # 毎テスト呼ばれるので接続は pool から借りる（connect + PRAGMA の初期化を毎回やらない）
+    with db_conn() as con:
+        con.executemany(sql, rows)
+
+
 def _ensure_note_exists(slug: str = "test") -> None:
-    con = db()
-    try:
-        cols = [r[1] for r in con.execute("PRAGMA table_info(notes)").fetchall()]
-        colset = set(cols)
-
-        values = {}
-        if "slug" in colset:
-            values["slug"] = slug
-        if "status" in colset:
-            values["status"] = "open"
-        if "first_seen" in colset:
-            values["first_seen"] = "1970-01-01T00:00:00Z"
-        if "last_seen" in colset:
-            values["last_seen"] = "1970-01-01T00:00:00Z"
-
-        if "created_at" in colset:
-            values["created_at"] = "1970-01-01T00:00:00Z"
-        if "updated_at" in colset:
-            values["updated_at"] = "1970-01-01T00:00:00Z"
-        if "is_deleted" in colset:
-            values["is_deleted"] = 0
-        if "is_archived" in colset:
-            values["is_archived"] = 0
-        if "title" in colset:
-            values["title"] = "test note"
-
-        cols_sql = ", ".join(values.keys())
-        qs_sql = ", ".join(["?"] * len(values))
-        con.execute(
-            f"INSERT OR IGNORE INTO notes ({cols_sql}) VALUES ({qs_sql})",
-            tuple(values.values()),
-        )
-        con.commit()
-    finally:
-        con.close()
+    _ensure_notes_exist((slug,))
+
+
+def _delete_notes(*slugs: str) -> None:
+    """テスト前の掃除: 複数 slug を pool の1接続・1コミットで消す"""
+    with db_conn() as con:
+        con.executemany("DELETE FROM notes WHERE slug = ?", [(s,) for s in slugs])
+
+
+@pytest.fixture(scope="session")
+def delete_notes():
+    """slug を消す関数を返す（再実行耐性のための掃除。db() を slug ごとに開き直さない）"""
+    return _delete_notes
 
 
 @pytest.fixture
-def client():
+def seed_notes():
+    """slug のリストを notes に seed する関数を返す（列の調査と INSERT 文は DB ごとに1回だけ作ってキャッシュ）"""
+    return _ensure_notes_exist
+
+
+@pytest.fixture(scope="session")
+def _session_auth_client():
+    """admin の AuthClient を session で1つだけ with して使い回す（lifespan / portal の立ち上げは1回）"""
+    with AuthClient() as c:
+        yield c
+
+
+@pytest.fixture
+def client(_session_auth_client):
     _ensure_note_exists("test")
-    return AuthClient()
+    c = _session_auth_client
+    # 共有 client なので前のテストの cookie（CSRF 等）は捨てて、admin の session だけ入れ直す
+    c.cookies.clear()
+    c.cookies.set("vnext_session", make_test_session("admin"), path="/")
+    return c
+
+
+@pytest.fixture(scope="session")
+def shared_client():
+    """
+    with 済み TestClient を (base_url, raise_server_exceptions) ごとに1つだけ作って session 中使い回す factory。
+    lifespan は最初の with の1回だけなので、テスト側は env / DB_PATH を差し替えた後に app._startup(app.app) を呼ぶ。
+    （with しない TestClient はリクエストごとに portal を立て直すので、リクエストの多いテストが逆に遅くなる）
+    """
+    from fastapi.testclient import TestClient
+
+    clients: dict[tuple[str, bool], TestClient] = {}
+
+    def get(base_url: str = "http://testserver", raise_server_exceptions: bool = True) -> TestClient:
+        key = (base_url, raise_server_exceptions)
+        c = clients.get(key)
+        if c is None:
+            c = TestClient(app.app, base_url=base_url, raise_server_exceptions=raise_server_exceptions)
+            c.__enter__()
+            clients[key] = c
+        c.cookies.clear()  # 共有 client なので前のテストのログイン状態を持ち越さない
+        return c
+
+    yield get
+    for c in clients.values():
+        c.__exit__(None, None, None)
+
+
+@pytest.fixture
+def memory_db_path():
+    """
+    テスト専用の共有キャッシュ in-memory DB（file: URI, db() は uri=True で開く）。ファイル作成 / WAL の fsync が無い。
+    最後の接続が閉じると消えるので anchor 接続を1本持ち、後始末で pool に残った接続もまとめて閉じる。
+    on-disk の成果物を検証するテスト（DB ファイルを作らない契約など）はファイルのままにすること。
+    """
+    db_path = Path(f"file:test-{uuid.uuid4().hex}?mode=memory&cache=shared")
+    anchor = sqlite3.connect(str(db_path), uri=True)
+    yield db_path
+    pool = app._CONN_POOLS.pop(str(db_path), None)
+    while pool is not None and not pool.empty():
+        pool.get_nowait().close()
+    app._PRAGMA_APPLIED_DBS.discard(str(db_path))
+    anchor.close()
 
 
 @pytest.fixture
@@ -100,6 +202,16 @@ def test_db():
     return app.DB_PATH
 
 
+@pytest.fixture
+def db_con(test_db):
+    """検証用の読み取り接続をテスト内で1本だけ使い回す（SELECT だけならトランザクションを持たないので app の書き込みも見える）"""
+    con = sqlite3.connect(str(test_db), uri=True)
+    try:
+        yield con
+    finally:
+        con.close()
+
+
 @pytest.fixture
 def temp_repo(tmp_path):
     return tmp_path
@@ -118,7 +230,7 @@ def reset_app_state():
         個別のテストから「退避→復元」のコードを削除できる（将来的に）。
     """
     # ---- Before ----
-    old_settings = getattr(app, "_SETTINGS", None)
+    old_settings = app._SETTINGS
     old_db_path = app.DB_PATH
     old_pragma_dbs = app._PRAGMA_APPLIED_DBS.copy()
 
@@ -144,7 +256,8 @@ def reset_app_state():
     # ---- After ----
     app._SETTINGS = old_settings
     app.DB_PATH = old_db_path
-    app._PRAGMA_APPLIED_DBS.clear()
+    # journal_mode=WAL は DB ファイルに永続するので、テスト中に適用済みになった DB は消さずに残す
+    # （clear すると共有DBを使う次のテストで PRAGMA journal_mode を打ち直す）。テストが clear した分だけ戻す
     app._PRAGMA_APPLIED_DBS.update(old_pragma_dbs)
 
     app._CSP_REPORT_SAMPLING.clear()
@@ -10,6 +10,7 @@ P2.5（CSP実装）で監査テーブルが欠損しないことを保証。
 「テーブルが消えてない / 参照できる」だけを契約化。
 """
 
+import sqlite3
 import sys
 from pathlib import Path
 
@@ -19,110 +20,91 @@ from starlette.testclient import TestClient
 import pytest
 
 
-def test_note_events_table_exists_and_readable(monkeypatch, tmp_path):
+_LIFESPAN_STATE_KEYS = ("csp_mode", "csp_policy", "mode", "csp_use_reporting_api", "csp_report_uri")
+
+
+@pytest.fixture(scope="module")
+def lifespan_db_path(tmp_path_factory):
+    """
+    新規DBに対して lifespan を1回だけ通し、そのDBパスを返す。
+    テーブル存在チェック3本はどれも「lifespan 経由で作られたスキーマ」を読むだけなので共有する。
+    module scope は autouse の reset_app_state より先に走るので、ここで触った状態は自前で戻す。
+    """
+    db_path = tmp_path_factory.mktemp("audit-lifespan") / "test.db"
+
+    old_state = {k: getattr(app.app.state, k, None) for k in _LIFESPAN_STATE_KEYS}
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("MODE", "local")
+        mp.setenv("CSP_MODE", "off")
+        mp.setenv("SESSION_SECRET", "test-secret")
+        mp.setenv("ADMIN_PASSWORD", "admin")
+        mp.setenv("DEV_PASSWORD", "dev")
+        mp.setenv("ALLOW_LOCAL_JSON_NOAUTH", "1")
+        mp.setenv("DB_PATH", str(db_path))
+
+        mp.setattr(app, "_SETTINGS", None)
+        mp.setattr(app, "DB_PATH", db_path)
+        try:
+            # Act: DBを初期化（lifespan経由）
+            with TestClient(app.app):
+                pass
+        finally:
+            # app.state は monkeypatch の対象外なので自前で戻す
+            for k, v in old_state.items():
+                setattr(app.app.state, k, v)
+
+    return db_path
+
+
+@pytest.fixture(scope="module")
+def lifespan_con(lifespan_db_path):
+    """lifespan で作られたスキーマを読むだけなので、検証用の接続も module で1本に"""
+    con = sqlite3.connect(lifespan_db_path)
+    yield con
+    con.close()
+
+
+def test_note_events_table_exists_and_readable(lifespan_con):
     """刺し⑤: note_events テーブルが存在して読み出せる（欠損防止）"""
-    # Setup
-    monkeypatch.setenv("MODE", "local")
-    monkeypatch.setenv("CSP_MODE", "off")
-    monkeypatch.setenv("SESSION_SECRET", "test-secret")
-    monkeypatch.setenv("ADMIN_PASSWORD", "admin")
-    monkeypatch.setenv("DEV_PASSWORD", "dev")
-    monkeypatch.setenv("ALLOW_LOCAL_JSON_NOAUTH", "1")
-    
-    db_path = tmp_path / "test.db"
-    monkeypatch.setenv("DB_PATH", str(db_path))
-    
-    app._SETTINGS = None
-    app.DB_PATH = db_path
-    app._PRAGMA_APPLIED_DBS.clear()
-    
-    # Act: DBを初期化（lifespan経由）
-    with TestClient(app.app) as client:
-        # テーブルが存在するか確認
-        import sqlite3
-        con = sqlite3.connect(db_path)
-        cursor = con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='note_events'")
-        table_exists = cursor.fetchone()
-        
-        # Assert: テーブルが存在する
-        assert table_exists is not None, "note_events テーブルが存在すること（監査データ欠損防止）"
-        
-        # Assert: 読み出せる（構造が壊れてない）
-        cursor = con.execute("SELECT id, note_id, event_type, changed_at FROM note_events LIMIT 0")
-        assert cursor.description is not None, "note_events が読み出せること（構造が壊れてない）"
-        
-        con.close()
-
-
-def test_evidence_table_exists_and_readable(monkeypatch, tmp_path):
+    cursor = lifespan_con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='note_events'")
+    table_exists = cursor.fetchone()
+
+    # Assert: テーブルが存在する
+    assert table_exists is not None, "note_events テーブルが存在すること（監査データ欠損防止）"
+
+    # Assert: 読み出せる（構造が壊れてない）
+    cursor = lifespan_con.execute("SELECT id, note_id, event_type, changed_at FROM note_events LIMIT 0")
+    assert cursor.description is not None, "note_events が読み出せること（構造が壊れてない）"
+
+
+def test_evidence_table_exists_and_readable(lifespan_con):
     """刺し⑤: evidence テーブルが存在して読み出せる（欠損防止）"""
-    # Setup
-    monkeypatch.setenv("MODE", "local")
-    monkeypatch.setenv("CSP_MODE", "off")
-    monkeypatch.setenv("SESSION_SECRET", "test-secret")
-    monkeypatch.setenv("ADMIN_PASSWORD", "admin")
-    monkeypatch.setenv("DEV_PASSWORD", "dev")
-    monkeypatch.setenv("ALLOW_LOCAL_JSON_NOAUTH", "1")
-    
-    db_path = tmp_path / "test.db"
-    monkeypatch.setenv("DB_PATH", str(db_path))
-    
-    app._SETTINGS = None
-    app.DB_PATH = db_path
-    app._PRAGMA_APPLIED_DBS.clear()
-    
-    # Act
-    with TestClient(app.app) as client:
-        import sqlite3
-        con = sqlite3.connect(db_path)
-        cursor = con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='evidence'")
-        table_exists = cursor.fetchone()
-        
-        # Assert: テーブルが存在する
-        assert table_exists is not None, "evidence テーブルが存在すること（監査データ欠損防止）"
-        
-        # Assert: 読み出せる
-        cursor = con.execute("SELECT id, note_id, filepath, created_at FROM evidence LIMIT 0")
-        assert cursor.description is not None, "evidence が読み出せること（構造が壊れてない）"
-        
-        con.close()
-
-
-def test_scan_log_table_exists_and_readable(monkeypatch, tmp_path):
+    cursor = lifespan_con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='evidence'")
+    table_exists = cursor.fetchone()
+
+    # Assert: テーブルが存在する
+    assert table_exists is not None, "evidence テーブルが存在すること（監査データ欠損防止）"
+
+    # Assert: 読み出せる（構造が壊れてない）
+    cursor = lifespan_con.execute("SELECT id, note_id, filepath, created_at FROM evidence LIMIT 0")
+    assert cursor.description is not None, "evidence が読み出せること（構造が壊れてない）"
+
+
+def test_scan_log_table_exists_and_readable(lifespan_con):
     """刺し⑤: scan_log テーブルが存在して読み出せる（欠損防止）"""
-    # Setup
-    monkeypatch.setenv("MODE", "local")
-    monkeypatch.setenv("CSP_MODE", "off")
-    monkeypatch.setenv("SESSION_SECRET", "test-secret")
-    monkeypatch.setenv("ADMIN_PASSWORD", "admin")
-    monkeypatch.setenv("DEV_PASSWORD", "dev")
-    monkeypatch.setenv("ALLOW_LOCAL_JSON_NOAUTH", "1")
-    
-    db_path = tmp_path / "test.db"
-    monkeypatch.setenv("DB_PATH", str(db_path))
-    
-    app._SETTINGS = None
-    app.DB_PATH = db_path
-    app._PRAGMA_APPLIED_DBS.clear()
-    
-    # Act
-    with TestClient(app.app) as client:
-        import sqlite3
-        con = sqlite3.connect(db_path)
-        cursor = con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='scan_log'")
-        table_exists = cursor.fetchone()
-        
-        # Assert: テーブルが存在する
-        assert table_exists is not None, "scan_log テーブルが存在すること（監査データ欠損防止）"
-        
-        # Assert: 読み出せる
-        cursor = con.execute("SELECT id, scanned_at, scanned_root FROM scan_log LIMIT 0")
-        assert cursor.description is not None, "scan_log が読み出せること（構造が壊れてない）"
-        
-        con.close()
-
-
-def test_export_endpoints_accessible(monkeypatch, tmp_path):
+    cursor = lifespan_con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='scan_log'")
+    table_exists = cursor.fetchone()
+
+    # Assert: テーブルが存在する
+    assert table_exists is not None, "scan_log テーブルが存在すること（監査データ欠損防止）"
+
+    # Assert: 読み出せる（構造が壊れてない）
+    cursor = lifespan_con.execute("SELECT id, scanned_at, scanned_root FROM scan_log LIMIT 0")
+    assert cursor.description is not None, "scan_log が読み出せること（構造が壊れてない）"
+
+
+def test_export_endpoints_accessible(monkeypatch, shared_client, memory_db_path):
     """刺し①: export系エンドポイントが動作する（監査データ参照可能）
     契約: local + localhost + JSON のときは no-auth で通る（B方針）
     """
@@ -133,42 +115,33 @@ def test_export_endpoints_accessible(monkeypatch, tmp_path):
     monkeypatch.setenv("DEV_PASSWORD", "dev")
     monkeypatch.setenv("ALLOW_LOCAL_JSON_NOAUTH", "1")
 
-    db_path = tmp_path / "test.db"
+    db_path = memory_db_path
     monkeypatch.setenv("DB_PATH", str(db_path))
 
     # Re-init（このテスト内で env/DB を差し替える）
     app._SETTINGS = None  # type: ignore[attr-defined]
     app.DB_PATH = db_path
-    app._PRAGMA_APPLIED_DBS.clear()
 
-    app.init_settings()
-    app.init_db()
-
-    # lifespan 相当の state 初期化（middleware 前提）
-    settings = app.get_settings()
-    app.app.state.csp_mode = settings.csp_mode
-    app.app.state.csp_policy = app._build_csp_policy(settings) if settings.csp_mode != "off" else None
-    app.app.state.mode = settings.mode
-    app.app.state.csp_use_reporting_api = settings.csp_use_reporting_api
-    app.app.state.csp_report_uri = settings.csp_report_uri
+    # lifespan と同じ起動処理（settings → P1 gate → init_db → app.state）を直接呼ぶ。client は session 共有
+    app._startup(app.app)
+    client = shared_client("http://127.0.0.1:8000")
 
-    with TestClient(app.app, base_url="http://127.0.0.1:8000") as client:
-        headers = {"Accept": "application/json"}
+    headers = {"Accept": "application/json"}
 
-        r_notes = client.get("/export/notes", headers=headers)
-        assert r_notes.status_code == 200, "export/notes が動作すること"
+    r_notes = client.get("/export/notes", headers=headers)
+    assert r_notes.status_code == 200, "export/notes が動作すること"
 
-        r_summary = client.get("/export/summary", headers=headers)
-        assert r_summary.status_code == 200, "export/summary が動作すること"
+    r_summary = client.get("/export/summary", headers=headers)
+    assert r_summary.status_code == 200, "export/summary が動作すること"
 
-        r_scan = client.get("/export/scan_history", headers=headers)
-        assert r_scan.status_code == 200, "export/scan_history が動作すること（scan_log参照）"
+    r_scan = client.get("/export/scan_history", headers=headers)
+    assert r_scan.status_code == 200, "export/scan_history が動作すること（scan_log参照）"
 
-        r_metrics = client.get("/export/metrics", headers=headers)
-        assert r_metrics.status_code == 200, "export/metrics が動作すること"
+    r_metrics = client.get("/export/metrics", headers=headers)
+    assert r_metrics.status_code == 200, "export/metrics が動作すること"
 
 
-def test_scan_endpoint_writes_to_db(monkeypatch, tmp_path):
+def test_scan_endpoint_writes_to_db(monkeypatch, tmp_path, shared_client, memory_db_path):
     """刺し①: /scan が動作してDBに書き込める（監査データ書き込み可能）
     契約: local + localhost + JSON のときは no-auth で通る（B方針）
     """
@@ -179,7 +152,7 @@ def test_scan_endpoint_writes_to_db(monkeypatch, tmp_path):
     monkeypatch.setenv("DEV_PASSWORD", "dev")
     monkeypatch.setenv("ALLOW_LOCAL_JSON_NOAUTH", "1")
 
-    db_path = tmp_path / "test.db"
+    db_path = memory_db_path
     monkeypatch.setenv("DB_PATH", str(db_path))
 
     scan_root = tmp_path / "scan_root"
@@ -189,31 +162,87 @@ def test_scan_endpoint_writes_to_db(monkeypatch, tmp_path):
     # Re-init
     app._SETTINGS = None  # type: ignore[attr-defined]
     app.DB_PATH = db_path
-    app._PRAGMA_APPLIED_DBS.clear()
 
-    app.init_settings()
+    # lifespan と同じ起動処理（settings → P1 gate → init_db → app.state）を直接呼ぶ。client は session 共有
+    app._startup(app.app)
+    client = shared_client("http://127.0.0.1:8000")
+
+    resp = client.post(
+        "/scan",
+        json={"root": str(scan_root), "full": True},
+        headers={"Accept": "application/json"},
+    )
+    assert resp.status_code == 200, "/scan が動作すること"
+
+    with app.db_conn() as con:
+        scan_log_count = con.execute("SELECT COUNT(*) FROM scan_log").fetchone()[0]
+    assert scan_log_count > 0, "scan_log にスキャン結果が記録されること"
+
+
+def test_init_db_dedupes_legacy_evidence_before_unique_index(monkeypatch, memory_db_path):
+    """刺し⑤: 旧DBの evidence 重複は init_db で1行に畳まれ、UNIQUE INDEX が作られる"""
+    import sqlite3
+
+    db_path = memory_db_path
+    monkeypatch.setattr(app, "DB_PATH", db_path)
     app.init_db()
 
-    # lifespan 相当の state 初期化（middleware 前提）
-    settings = app.get_settings()
-    app.app.state.csp_mode = settings.csp_mode
-    app.app.state.csp_policy = app._build_csp_policy(settings) if settings.csp_mode != "off" else None
-    app.app.state.mode = settings.mode
-    app.app.state.csp_use_reporting_api = settings.csp_use_reporting_api
-    app.app.state.csp_report_uri = settings.csp_report_uri
-
-    with TestClient(app.app, base_url="http://127.0.0.1:8000") as client:
-        resp = client.post(
-            "/scan",
-            json={"root": str(scan_root), "full": True},
-            headers={"Accept": "application/json"},
+    con = sqlite3.connect(str(db_path), uri=True)
+    con.execute("DROP INDEX idx_evidence_uniq")
+    con.execute(
+        "INSERT INTO notes (slug, status, created_at, updated_at) VALUES ('dup', 'open', 'x', 'x')"
+    )
+    for _ in range(3):
+        con.execute(
+            "INSERT INTO evidence (note_id, filepath, line_no, snippet, created_at) VALUES (1, 'a.py', 1, 's', 'x')"
         )
-        assert resp.status_code == 200, "/scan が動作すること"
+    con.commit()
+    con.close()
+
+    app.init_db()
+
+    con = sqlite3.connect(str(db_path), uri=True)
+    count = con.execute("SELECT COUNT(*) FROM evidence").fetchone()[0]
+    index = con.execute(
+        "SELECT name FROM sqlite_master WHERE type='index' AND name='idx_evidence_uniq'"
+    ).fetchone()
+    con.close()
 
+    assert count == 1, "重複 evidence は最古の1行だけ残ること"
+    assert index is not None, "idx_evidence_uniq が作られること"
+
+
+def test_notes_evidence_count_is_maintained_by_triggers(monkeypatch, memory_db_path):
+    """刺し⑤: notes.evidence_count は evidence の追加/削除に追従し、トリガの無い旧DBは init_db で埋め直される"""
     import sqlite3
-    con = sqlite3.connect(db_path)
-    try:
-        scan_log_count = con.execute("SELECT COUNT(*) FROM scan_log").fetchone()[0]
-        assert scan_log_count > 0, "scan_log にスキャン結果が記録されること"
-    finally:
-        con.close()
+
+    db_path = memory_db_path
+    monkeypatch.setattr(app, "DB_PATH", db_path)
+    app.init_db()
+
+    con = sqlite3.connect(str(db_path), uri=True)
+    con.execute(
+        "INSERT INTO notes (slug, status, created_at, updated_at) VALUES ('cnt', 'open', 'x', 'x')"
+    )
+    for line_no in (1, 2, 3):
+        con.execute(
+            "INSERT INTO evidence (note_id, filepath, line_no, snippet, created_at) VALUES (1, 'a.py', ?, 's', 'x')",
+            (line_no,),
+        )
+    con.execute("DELETE FROM evidence WHERE line_no = 3")
+    con.commit()
+    assert con.execute("SELECT evidence_count FROM notes WHERE id = 1").fetchone()[0] == 2
+
+    # 旧DB相当: トリガ無し + 件数がずれている
+    for name in ("trg_evidence_count_ins", "trg_evidence_count_del", "trg_evidence_count_upd"):
+        con.execute(f"DROP TRIGGER {name}")
+    con.execute("UPDATE notes SET evidence_count = 0")
+    con.commit()
+    con.close()
+
+    app.init_db()
+
+    con = sqlite3.connect(str(db_path), uri=True)
+    count = con.execute("SELECT evidence_count FROM notes WHERE id = 1").fetchone()[0]
+    con.close()
+    assert count == 2, "トリガ作成時に evidence_count が実数で埋め直されること"
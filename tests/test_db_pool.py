@@ -0,0 +1,32 @@
+# tests/test_db_pool.py
+import pytest
+
+import app
+from app import db_conn
+
+
+def test_db_conn_reuses_pooled_connection():
+    """Contract: db_conn() returns the same connection to the pool after a clean block."""
+    with db_conn() as con1:
+        con1.execute("SELECT 1").fetchone()
+    with db_conn() as con2:
+        con2.execute("SELECT 1").fetchone()
+    assert con1 is con2
+
+
+def test_db_conn_rolls_back_on_exception():
+    """Contract: same semantics as `with db() as con` (rollback on exception)."""
+    slug = "pool_rollback_probe"
+    with pytest.raises(RuntimeError):
+        with db_conn() as con:
+            con.execute(
+                "INSERT INTO notes (slug, status, created_at, updated_at) VALUES (?, 'open', 'x', 'x')",
+                (slug,),
+            )
+            raise RuntimeError("boom")
+
+    with db_conn() as con:
+        row = con.execute("SELECT 1 FROM notes WHERE slug = ?", (slug,)).fetchone()
+        assert not con.in_transaction
+    assert row is None
+    assert app._CONN_POOLS[str(app.DB_PATH)].qsize() >= 1
@@ -2,39 +2,28 @@
 
 from pathlib import Path
 
-from app import db
+import pytest
 
+from app import db_conn
+from tests.helpers.auth import AuthClient
 
-def _delete_note(slug: str) -> None:
-    con = db()
-    try:
-        con.execute("DELETE FROM notes WHERE slug = ?", (slug,))
-        con.commit()
-    finally:
-        con.close()
-
-
-def _insert_note(slug: str, *, is_deleted: int = 0, is_archived: int = 0) -> None:
-    con = db()
-    try:
-        # 既にあれば消してから入れ直す（再実行耐性）
-        con.execute("DELETE FROM notes WHERE slug = ?", (slug,))
 
+def _insert_notes(rows: list[tuple[str, int, int]]) -> None:
+    """(slug, is_deleted, is_archived) をまとめて1接続・1コミットで入れる"""
+    with db_conn() as con:
+        # 既にあれば入れ直す（再実行耐性）。slug は UNIQUE なので OR REPLACE で DELETE + INSERT を1文にする
         # v4 schema 前提: created_at/updated_at は NOT NULL
-        con.execute(
+        con.executemany(
             """
-            INSERT INTO notes (
+            INSERT OR REPLACE INTO notes (
               slug, first_seen, last_seen, evidence_count, status, priority,
               created_at, updated_at, is_deleted, is_archived
             )
             VALUES (?, '1970-01-01T00:00:00Z', '1970-01-01T00:00:00Z', 0, 'open', 3,
                     '1970-01-01T00:00:00Z', '1970-01-01T00:00:00Z', ?, ?)
             """,
-            (slug, is_deleted, is_archived),
+            rows,
         )
-        con.commit()
-    finally:
-        con.close()
 
 
 def test_export_notes_excludes_deleted_and_archived_by_default(client):
@@ -42,9 +31,11 @@ def test_export_notes_excludes_deleted_and_archived_by_default(client):
     deleted = "exp_deleted"
     archived = "exp_archived"
 
-    _insert_note(active, is_deleted=0, is_archived=0)
-    _insert_note(deleted, is_deleted=1, is_archived=0)
-    _insert_note(archived, is_deleted=0, is_archived=1)
+    _insert_notes([
+        (active, 0, 0),
+        (deleted, 1, 0),
+        (archived, 0, 1),
+    ])
 
     r = client.get("/export/notes")
     assert r.status_code == 200
@@ -60,9 +51,11 @@ def test_export_notes_can_include_deleted_and_archived(client):
     deleted = "exp2_deleted"
     archived = "exp2_archived"
 
-    _insert_note(active, is_deleted=0, is_archived=0)
-    _insert_note(deleted, is_deleted=1, is_archived=0)
-    _insert_note(archived, is_deleted=0, is_archived=1)
+    _insert_notes([
+        (active, 0, 0),
+        (deleted, 1, 0),
+        (archived, 0, 1),
+    ])
 
     r = client.get("/export/notes?include_deleted=1&include_archived=1")
     assert r.status_code == 200
@@ -73,35 +66,200 @@ def test_export_notes_can_include_deleted_and_archived(client):
     assert archived in slugs
 
 
-def test_scan_adds_note_minimal_case(client, tmp_path: Path):
-    slug = "scan_min"
-    _delete_note(slug)
+_SCAN_MIN = "scan_min"
+_SCAN_UNICODE = "日本語テスト"
+_SCAN_KEPT = "scan_kept"
+_SCAN_SKIPPED = "scan_in_node_modules"
+
+
+@pytest.fixture(scope="module")
+def scanned_tree(tmp_path_factory, delete_notes):
+    """
+    下の3テスト用のツリーを module で1回だけ作って1回だけ scan する（各テストは結果を読むだけ）。
+    returns: (scan のレスポンス JSON, export に出た slug の set)
+    """
+    delete_notes(_SCAN_MIN, _SCAN_UNICODE, _SCAN_KEPT, _SCAN_SKIPPED)
 
+    root = tmp_path_factory.mktemp("export-and-scan")
     # 最小の対象ファイル（拡張子は SCAN_EXTS に合わせて .py）
-    p = tmp_path / "a.py"
-    p.write_text(f"# NOTE(vNext): {slug}\n", encoding="utf-8")
+    (root / "a.py").write_text(f"# NOTE(vNext): {_SCAN_MIN}\n", encoding="utf-8")
+    (root / "u.py").write_text(f"# NOTE(vNext): {_SCAN_UNICODE}\n", encoding="utf-8")
+    (root / "src").mkdir()
+    (root / "src" / "a.py").write_text(f"# NOTE(vNext): {_SCAN_KEPT}\n", encoding="utf-8")
+    nm = root / "node_modules" / "pkg"
+    nm.mkdir(parents=True)
+    (nm / "index.js").write_text(f"// NOTE(vNext): {_SCAN_SKIPPED}\n", encoding="utf-8")
 
     # local mode の想定: req.root が使われる
-    r = client.post("/scan?full=0", json={"root": str(tmp_path)})
+    client = AuthClient()
+    r = client.post("/scan?full=0", json={"root": str(root)})
     assert r.status_code == 200
 
-    # 反映確認: export に現れる
     r2 = client.get("/export/notes")
-    slugs = {n["slug"] for n in r2.json()["notes"]}
-    assert slug in slugs
+    assert r2.status_code == 200
+    return r.json(), {n["slug"] for n in r2.json()["notes"]}
 
 
-def test_scan_picks_unicode_slug_and_exports(client, tmp_path):
+def test_scan_adds_note_minimal_case(scanned_tree):
+    # 反映確認: export に現れる
+    _, slugs = scanned_tree
+    assert _SCAN_MIN in slugs
+
+
+def test_scan_picks_unicode_slug_and_exports(scanned_tree):
     """Contract: Unicode slug (e.g. 日本語) must be scannable and exportable."""
-    slug = "日本語テスト"
-    _delete_note(slug)
+    _, slugs = scanned_tree
+    assert _SCAN_UNICODE in slugs
+
+
+def test_scan_skips_exclude_dirs(scanned_tree):
+    """Contract: NOTE tags under EXCLUDE_DIRS (node_modules 等) are never collected."""
+    result, slugs = scanned_tree
+    # a.py / u.py / src/a.py の3件だけ（node_modules 配下は walk されない）
+    assert result["files_scanned"] == 3
+    assert _SCAN_KEPT in slugs
+    assert _SCAN_SKIPPED not in slugs
+
+
+def test_collect_hits_parallel_matches_sequential(tmp_path: Path, monkeypatch):
+    """Contract: the thread-pool path returns the same hits (same order) as the sequential path."""
+    import app
+
+    for i in range(5):
+        (tmp_path / f"f{i}.py").write_text(
+            f"# NOTE(vNext): par_{i}\nx = 1\n# DONE(vNext): par_{i}\n", encoding="utf-8"
+        )
+    files = sorted(app.iter_source_files(tmp_path))
+
+    monkeypatch.setattr(app, "_SCAN_PARALLEL_MIN_FILES", 10**9)
+    sequential = app.collect_hits_from_files(tmp_path, files)
+    monkeypatch.setattr(app, "_SCAN_PARALLEL_MIN_FILES", 1)
+    parallel = app.collect_hits_from_files(tmp_path, files)
+
+    assert len(sequential) == 10
+    assert parallel == sequential
+
+
+def test_done_tag_forces_done_and_records_event_once(client, tmp_path: Path, delete_notes):
+    """Contract: DONE(vNext) moves an active note to done with one status_change event (open → done)."""
+    slug = "scan_force_done"
+    delete_notes(slug)
 
     p = tmp_path / "a.py"
     p.write_text(f"# NOTE(vNext): {slug}\n", encoding="utf-8")
+    r = client.post("/scan?full=1", json={"root": str(tmp_path)})
+    assert r.status_code == 200
 
-    r = client.post("/scan?full=0", json={"root": str(tmp_path)})
+    p.write_text(f"# DONE(vNext): {slug}\n", encoding="utf-8")
+    r = client.post("/scan?full=1", json={"root": str(tmp_path)})
     assert r.status_code == 200
+    assert r.json()["done_forced"] == 1
 
-    r2 = client.get("/export/notes")
-    slugs = {n["slug"] for n in r2.json()["notes"]}
-    assert slug in slugs
+    # 既に done: 再スキャンしても遷移もイベントも増えない
+    r = client.post("/scan?full=1", json={"root": str(tmp_path)})
+    assert r.json()["done_forced"] == 0
+
+    r = client.get(f"/notes/{slug}", headers={"Accept": "application/json"})
+    body = r.json()
+    assert body["note"]["status"] == "done"
+    changes = [e for e in body["events"] if e["event_type"] == "status_change"]
+    assert [(e["old_value"], e["new_value"]) for e in changes] == [("open", "done")]
+
+
+def test_scan_repeated_slug_creates_one_note_with_one_created_event(client, tmp_path: Path, delete_notes):
+    """Contract: the same slug on many lines/files yields one note, one 'created' event, evidence per line."""
+    slug = "scan_bulk_upsert"
+    delete_notes(slug)
+
+    (tmp_path / "a.py").write_text(f"# NOTE(vNext): {slug}\n# NOTE(vNext): {slug}\n", encoding="utf-8")
+    (tmp_path / "b.py").write_text(f"# NOTE(vNext): {slug}\n", encoding="utf-8")
+    r = client.post("/scan?full=1", json={"root": str(tmp_path)})
+    assert r.status_code == 200
+    assert r.json()["evidence_added"] == 3
+
+    r = client.get(f"/notes/{slug}", headers={"Accept": "application/json"})
+    body = r.json()
+    assert body["note"]["status"] == "open"
+    assert len(body["evidence"]) == 3
+    assert [e["event_type"] for e in body["events"]] == ["created"]
+
+
+def test_scan_file_line_numbers_match_for_lf_and_crlf(tmp_path: Path):
+    """Contract: hit line numbers/snippets follow str.splitlines() for both LF and CRLF files."""
+    from app import _scan_file
+
+    lines = ["x = 1", "# NOTE(vNext): lf_a", "", "y = 2  # done(vnext): lf_b  NOTE(vNext): lf_c", "z"]
+    (tmp_path / "lf.py").write_bytes("\n".join(lines).encode("utf-8"))
+    (tmp_path / "crlf.py").write_bytes("\r\n".join(lines).encode("utf-8"))
+
+    def key(hits):
+        return [(h.kind, h.slug, h.line, h.snippet) for h in hits]
+
+    lf = key(_scan_file(tmp_path, tmp_path / "lf.py"))
+    crlf = key(_scan_file(tmp_path, tmp_path / "crlf.py"))
+    assert lf == crlf
+    # 同じ行では NOTE 全部 → DONE 全部の順
+    assert [(k, s, n) for k, s, n, _ in lf] == [("note", "lf_a", 2), ("note", "lf_c", 4), ("done", "lf_b", 4)]
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        # slug の \S+ に続けて書かれた DONE も拾う（force_done が効く）
+        ("# NOTE(vNext):x,DONE(vNext):x", [("note", "x,DONE(vNext):x"), ("done", "x")]),
+        ("# DONE(vNext):y;NOTE(vNext):y", [("note", "y"), ("done", "y;NOTE(vNext):y")]),
+        # 位置ではなく NOTE 全部 → DONE 全部の順（採番順を変えない）
+        ("# DONE(vNext): d1 NOTE(vNext): n1 DONE(vNext): d2 NOTE(vNext): n2",
+         [("note", "n1"), ("note", "n2"), ("done", "d1"), ("done", "d2")]),
+    ],
+)
+def test_scan_file_finds_run_together_tags_notes_before_dones(tmp_path: Path, line, expected):
+    """Contract: NOTE と DONE は別々に走査する（run-together のタグも拾い、1行内の順は NOTE → DONE）"""
+    from app import _scan_file
+
+    (tmp_path / "a.py").write_bytes(line.encode("utf-8") + b"\n")
+    assert [(h.kind, h.slug) for h in _scan_file(tmp_path, tmp_path / "a.py")] == expected
+
+
+def test_diff_scan_skips_mtime_only_change_once_hash_is_known(client, tmp_path: Path):
+    """Contract: a touch without content change is not re-scanned once file_state has its content_hash."""
+    import os
+
+    p = tmp_path / "hashdiff_touch_probe.py"
+    p.write_text("# NOTE(vNext): scan_hashdiff_touch\n", encoding="utf-8")
+
+    def touch_and_scan(bump: int) -> int:
+        st = p.stat()
+        os.utime(p, ns=(st.st_atime_ns, st.st_mtime_ns + bump))
+        r = client.post("/scan", json={"root": str(tmp_path)})
+        assert r.status_code == 200
+        return r.json()["files_scanned"]
+
+    assert touch_and_scan(0) == 1  # 初回: file_state なし → スキャンで読んだ bytes の hash を保存
+    assert touch_and_scan(10**9) == 0  # hash 一致: mtime だけ更新してスキャンしない
+
+    p.write_text("# NOTE(vNext): scan_hashdiff_touc2\n", encoding="utf-8")  # 同じ size で中身だけ変更
+    assert touch_and_scan(10**9) == 1
+    assert touch_and_scan(10**9) == 0
+
+
+def test_diff_scan_skips_mtime_only_change_after_size_changing_edit(client, tmp_path: Path):
+    """Contract: size が変わる編集でスキャンした後も hash は入れ直されるので、次の touch だけでは再スキャンしない"""
+    import os
+
+    p = tmp_path / "hashdiff_edit_probe.py"
+    p.write_bytes(b"# NOTE(vNext): scan_hashdiff_edit\n")
+
+    def scan() -> int:
+        r = client.post("/scan", json={"root": str(tmp_path)})
+        assert r.status_code == 200
+        return r.json()["files_scanned"]
+
+    assert scan() == 1
+
+    p.write_bytes(b"# NOTE(vNext): scan_hashdiff_edit\nx = 1\n")  # 普通の編集（size が変わる）
+    assert scan() == 1
+
+    st = p.stat()
+    os.utime(p, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))  # 中身はそのまま mtime だけ（checkout / rsync -a 等）
+    assert scan() == 0
@@ -1,10 +1,6 @@
 # tests/test_p1_hardening.py
 from __future__ import annotations
 
-import importlib.util
-import os
-import sys
-import uuid
 from pathlib import Path
 
 import pytest
@@ -13,20 +9,6 @@ from fastapi.testclient import TestClient
 import app
 
 
-def _load_isolated_app_module(app_py: Path):
-    """
-    conftest.py が import app 済みでも影響しないように、
-    app.py を “別モジュール名” でロードして分離する。
-    """
-    name = f"_isolated_app_{uuid.uuid4().hex}"
-    spec = importlib.util.spec_from_file_location(name, app_py)
-    assert spec and spec.loader
-    mod = importlib.util.module_from_spec(spec)
-    sys.modules[name] = mod
-    spec.loader.exec_module(mod)
-    return mod
-
-
 def test_prod_gate_blocks_startup_and_db_init(monkeypatch, tmp_path):
     """
     (1) “起動時に落ちる”の統合テスト（最重要）
@@ -46,11 +28,14 @@ def test_prod_gate_blocks_startup_and_db_init(monkeypatch, tmp_path):
     # CIフラグ無し（ここが要点）
     monkeypatch.delenv("P1_CONTRACT_VERIFIED", raising=False)
 
-    isolated = _load_isolated_app_module(Path(app.__file__).resolve())
+    # app.py を別モジュールとして読み直さず、既存の app のまま DB_PATH / settings だけ差し替える
+    # （DB_PATH は import 時に env から読まれるので属性を直接。どちらも monkeypatch が戻す）
+    monkeypatch.setattr(app, "DB_PATH", db_path)
+    monkeypatch.setattr(app, "_SETTINGS", None)
 
     # startup(lifespan) で gate が落とす
     with pytest.raises(RuntimeError):
-        with TestClient(isolated.app):
+        with TestClient(app.app):
             pass
 
     # gate が落ちたので DB 初期化は走ってないはず（ファイルが存在しない）
@@ -154,7 +139,7 @@ def test_evidence_dedup_by_file_and_line(client, temp_repo: Path):
     r = client.post("/scan?full=1", json={"root": str(temp_repo)})
     assert r.status_code == 200
 
-    with app.db() as con:
+    with app.db_conn() as con:
         note_row = con.execute("SELECT id FROM notes WHERE slug = ?", (slug,)).fetchone()
         assert note_row is not None
         note_id = note_row["id"]
@@ -12,7 +12,7 @@ def _get_note(con: sqlite3.Connection, slug: str):
     ).fetchone()
 
 
-def test_p1_noop_patch_returns_204_and_no_pollution(client, test_db: Path, temp_repo: Path):
+def test_p1_noop_patch_returns_204_and_no_pollution(client, db_con: sqlite3.Connection, temp_repo: Path):
     slug = "noop_slug"
 
     # NOTE を作る → DBに note を生やす
@@ -20,29 +20,21 @@ def test_p1_noop_patch_returns_204_and_no_pollution(client, test_db: Path, temp_
     p.write_text(f"# NOTE(vNext): {slug}\n", encoding="utf-8")
     client.post("/scan?full=1", json={"root": str(temp_repo)})
 
-    con = sqlite3.connect(test_db)
-    try:
-        row = _get_note(con, slug)
-        assert row is not None
-        note_id, old_status, old_priority, old_updated_at = row
+    row = _get_note(db_con, slug)
+    assert row is not None
+    note_id, old_status, old_priority, old_updated_at = row
 
-        events_before = con.execute("SELECT COUNT(*) FROM note_events WHERE note_id = ?", (note_id,)).fetchone()[0]
-    finally:
-        con.close()
+    events_before = db_con.execute("SELECT COUNT(*) FROM note_events WHERE note_id = ?", (note_id,)).fetchone()[0]
 
     # no-op PATCH（同値を入れる）
     r = client.patch(f"/notes/{slug}", json={"status": old_status, "priority": old_priority})
     assert r.status_code == 204, "Contract violation: no-op PATCH must return 204"
 
-    con = sqlite3.connect(test_db)
-    try:
-        row2 = _get_note(con, slug)
-        assert row2 is not None
-        _, _, _, updated_after = row2
+    row2 = _get_note(db_con, slug)
+    assert row2 is not None
+    _, _, _, updated_after = row2
 
-        events_after = con.execute("SELECT COUNT(*) FROM note_events WHERE note_id = ?", (note_id,)).fetchone()[0]
-    finally:
-        con.close()
+    events_after = db_con.execute("SELECT COUNT(*) FROM note_events WHERE note_id = ?", (note_id,)).fetchone()[0]
 
     assert updated_after == old_updated_at, "Contract violation: no-op PATCH must not change updated_at"
     assert events_after == events_before, "Contract violation: no-op PATCH must not create events"
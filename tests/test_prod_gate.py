@@ -1,91 +1,67 @@
 # tests/test_prod_gate.py
-from pathlib import Path
-import os
+import re
+
 import pytest
 import app
 
 
-def _restore_app_state(old_settings, old_db_path):
-    # グローバルを元に戻す（他テストへ影響させない）
-    if hasattr(app, "_SETTINGS"):
-        app._SETTINGS = old_settings
-    app.DB_PATH = old_db_path
+# prod に必要な前提（load_settings が先に落ちないように）
+_PROD_ENV = {
+    "MODE": "prod",
+    "ADMIN_PASSWORD": "admin",
+    "DEV_PASSWORD": "dev",
+    "SESSION_SECRET": "test-secret",
+}
 
+# pytest.raises(match=) は Pattern もそのまま受け取るので、import 時に1回だけ compile しておく
+_GATE_RE = re.compile("P1 contract gate")
+_NOAUTH_IN_PROD_RE = re.compile("ALLOW_LOCAL_JSON_NOAUTH must be disabled")
 
-def test_prod_gate_requires_ci_verification(monkeypatch, tmp_path):
-    old_settings = getattr(app, "_SETTINGS", None)
-    old_db_path = app.DB_PATH
-    try:
-        # prod に必要な前提（load_settings が先に落ちないように）
-        monkeypatch.setenv("MODE", "prod")
-        monkeypatch.setenv("ADMIN_PASSWORD", "admin")
-        monkeypatch.setenv("DEV_PASSWORD", "dev")
-        monkeypatch.setenv("SESSION_SECRET", "test-secret")
 
-        # CIフラグ無し
-        monkeypatch.delenv("P1_CONTRACT_VERIFIED", raising=False)
+@pytest.fixture(scope="module")
+def _prod_settings_cached():
+    """prod の Settings は gate の2テストで同じなので module で1回だけ作る（P1_CONTRACT_VERIFIED は gate が毎回 env から読む）"""
+    with pytest.MonkeyPatch.context() as mp:
+        for k, v in _PROD_ENV.items():
+            mp.setenv(k, v)
+        mp.delenv("ALLOW_LOCAL_JSON_NOAUTH", raising=False)
+        return app.load_settings()
 
-        # DBはテスト用tmpへ
-        monkeypatch.setenv("DB_PATH", str(tmp_path / "ledger.sqlite3"))
-        app.DB_PATH = Path(os.environ["DB_PATH"])
 
-        # settings を作り直して gate を踏む
-        if hasattr(app, "_SETTINGS"):
-            app._SETTINGS = None
-        app.init_settings()
+@pytest.fixture
+def prod_settings(monkeypatch, _prod_settings_cached):
+    # グローバルは monkeypatch が戻す → 他テストへ影響させない
+    for k, v in _PROD_ENV.items():
+        monkeypatch.setenv(k, v)
+    monkeypatch.setattr(app, "_SETTINGS", _prod_settings_cached)
+    return _prod_settings_cached
 
-        with pytest.raises(RuntimeError, match="P1 contract gate"):
-            app.check_p1_contract_gate()
-    finally:
-        _restore_app_state(old_settings, old_db_path)
 
+def test_prod_gate_requires_ci_verification(monkeypatch, prod_settings):
+    # CIフラグ無し
+    monkeypatch.delenv("P1_CONTRACT_VERIFIED", raising=False)
 
-def test_prod_gate_allows_ci_verified(monkeypatch, tmp_path):
-    old_settings = getattr(app, "_SETTINGS", None)
-    old_db_path = app.DB_PATH
-    try:
-        monkeypatch.setenv("MODE", "prod")
-        monkeypatch.setenv("ADMIN_PASSWORD", "admin")
-        monkeypatch.setenv("DEV_PASSWORD", "dev")
-        monkeypatch.setenv("SESSION_SECRET", "test-secret")
+    with pytest.raises(RuntimeError, match=_GATE_RE):
+        app.check_p1_contract_gate()
 
-        # CIフラグあり
-        monkeypatch.setenv("P1_CONTRACT_VERIFIED", "1")
 
-        monkeypatch.setenv("DB_PATH", str(tmp_path / "ledger.sqlite3"))
-        app.DB_PATH = Path(os.environ["DB_PATH"])
+def test_prod_gate_allows_ci_verified(monkeypatch, prod_settings):
+    # CIフラグあり
+    monkeypatch.setenv("P1_CONTRACT_VERIFIED", "1")
 
+    # 例外が出なければOK
+    app.check_p1_contract_gate()
 
-        if hasattr(app, "_SETTINGS"):
-            app._SETTINGS = None
-        app.init_settings()
 
-        # 例外が出なければOK
-        app.check_p1_contract_gate()
-    finally:
-        _restore_app_state(old_settings, old_db_path)
+def test_prod_disallows_allow_local_json_noauth(monkeypatch):
+    """安全弁: MODE=prod では ALLOW_LOCAL_JSON_NOAUTH を絶対に許可しない"""
+    for k, v in _PROD_ENV.items():
+        monkeypatch.setenv(k, v)
 
+    # これを prod で許すと事故るので禁止（契約）
+    monkeypatch.setenv("ALLOW_LOCAL_JSON_NOAUTH", "1")
 
-def test_prod_disallows_allow_local_json_noauth(monkeypatch, tmp_path):
-    """安全弁: MODE=prod では ALLOW_LOCAL_JSON_NOAUTH を絶対に許可しない"""
-    old_settings = getattr(app, "_SETTINGS", None)
-    old_db_path = app.DB_PATH
-    try:
-        monkeypatch.setenv("MODE", "prod")
-        monkeypatch.setenv("ADMIN_PASSWORD", "admin")
-        monkeypatch.setenv("DEV_PASSWORD", "dev")
-        monkeypatch.setenv("SESSION_SECRET", "test-secret")
-
-        # これを prod で許すと事故るので禁止（契約）
-        monkeypatch.setenv("ALLOW_LOCAL_JSON_NOAUTH", "1")
-
-        monkeypatch.setenv("DB_PATH", str(tmp_path / "ledger.sqlite3"))
-        app.DB_PATH = Path(os.environ["DB_PATH"])
-
-        if hasattr(app, "_SETTINGS"):
-            app._SETTINGS = None
-
-        with pytest.raises(RuntimeError, match="ALLOW_LOCAL_JSON_NOAUTH must be disabled"):
-            app.init_settings()
-    finally:
-        _restore_app_state(old_settings, old_db_path)
\ No newline at end of file
+    monkeypatch.setattr(app, "_SETTINGS", None)
+
+    with pytest.raises(RuntimeError, match=_NOAUTH_IN_PROD_RE):
+        app.init_settings()
\ No newline at end of file
@@ -1,21 +1,15 @@
 # tests/test_scan_encoding_errors.py
-from app import db
 
 
-def test_scan_skips_non_utf8_files(client, tmp_path):
+def test_scan_skips_non_utf8_files(client, tmp_path, delete_notes):
     """Contract: scan must skip non-UTF-8 files without crashing."""
     # Delete note if exists (self-contained, no import from other test files)
     slug = "valid_slug"
-    con = db()
-    try:
-        con.execute("DELETE FROM notes WHERE slug = ?", (slug,))
-        con.commit()
-    finally:
-        con.close()
+    delete_notes(slug)
     
     # Create a valid UTF-8 file with NOTE
     valid = tmp_path / "valid.py"
-    valid.write_text("# NOTE(vNext): valid_slug\n", encoding="utf-8")
+    valid.write_bytes(b"# NOTE(vNext): valid_slug\n")
     
     # Create a non-UTF-8 file with .py extension (will be scanned but fail to decode)
     # Using Latin-1 bytes that are invalid UTF-8
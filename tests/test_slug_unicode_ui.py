@@ -2,20 +2,13 @@
 import html
 from urllib.parse import quote
 
-from app import db
 
-
-def test_notes_table_html_renders_unicode_slug_and_encoded_href(client, tmp_path):
+def test_notes_table_html_renders_unicode_slug_and_encoded_href(client, tmp_path, delete_notes):
     """Contract: /notes/table HTML must display Unicode slug and encode href properly."""
     slug = "日本語/パス"
     
     # Setup: delete note if exists (self-contained)
-    con = db()
-    try:
-        con.execute("DELETE FROM notes WHERE slug = ?", (slug,))
-        con.commit()
-    finally:
-        con.close()
+    delete_notes(slug)
     
     p = tmp_path / "unicode.py"
     p.write_text(f"# NOTE(vNext): {slug}\n", encoding="utf-8")
@@ -1,28 +1,28 @@
 # tests/test_table_filters.py
 from __future__ import annotations
 
-from app import db
+import pytest
 
-
-def _delete_note(slug: str) -> None:
-    con = db()
-    try:
-        con.execute("DELETE FROM notes WHERE slug = ?", (slug,))
-        con.commit()
-    finally:
-        con.close()
+from app import db_conn
+from tests.helpers.auth import AuthClient
 
 
-def test_notes_table_filters_priority_and_comment(client, tmp_path):
+@pytest.fixture(scope="module")
+def filter_notes(tmp_path_factory, delete_notes):
+    """
+    フィルタ検証用の2件を module で1回だけ作る（下の parametrize 各ケースは読むだけなので共有）。
+    a: comment あり / priority なし、b: comment なし / priority=1
+    """
     a = "flt_a"
     b = "flt_b"
-    _delete_note(a)
-    _delete_note(b)
+    delete_notes(a, b)
 
-    (tmp_path / "a.py").write_text(f"# NOTE(vNext): {a}\n", encoding="utf-8")
-    (tmp_path / "b.py").write_text(f"# NOTE(vNext): {b}\n", encoding="utf-8")
+    root = tmp_path_factory.mktemp("table-filters")
+    (root / "a.py").write_text(f"# NOTE(vNext): {a}\n", encoding="utf-8")
+    (root / "b.py").write_text(f"# NOTE(vNext): {b}\n", encoding="utf-8")
 
-    r = client.post("/scan?full=0", json={"root": str(tmp_path)})
+    client = AuthClient()
+    r = client.post("/scan?full=0", json={"root": str(root)})
     assert r.status_code == 200
 
     # New notes default to priority=None
@@ -38,32 +38,89 @@ def test_notes_table_filters_priority_and_comment(client, tmp_path):
     r = client.patch(f"/notes/{b}", json={"priority": 1})
     assert r.status_code == 200
 
-    # comment=any -> must include a, exclude b
-    r = client.get("/notes/table?comment=any", headers={"accept": "application/json"})
-    assert r.status_code == 200
-    slugs = [n["slug"] for n in r.json()["notes"]]
-    assert a in slugs and b not in slugs
+    return {"a": a, "b": b}
 
-    # comment=none -> must include b, exclude a
-    r = client.get("/notes/table?comment=none", headers={"accept": "application/json"})
-    assert r.status_code == 200
-    slugs = [n["slug"] for n in r.json()["notes"]]
-    assert b in slugs and a not in slugs
 
-    # priority=1 -> must include b, exclude a
-    r = client.get("/notes/table?priority=1", headers={"accept": "application/json"})
+@pytest.mark.parametrize(
+    "query, must_in, must_out",
+    [
+        # comment=any -> must include a, exclude b
+        ("comment=any", "a", "b"),
+        # comment=none -> must include b, exclude a
+        ("comment=none", "b", "a"),
+        # priority=1 -> must include b, exclude a
+        ("priority=1", "b", "a"),
+        # priority=none -> must include a, exclude b
+        ("priority=none", "a", "b"),
+        # combined -> must include a, exclude b
+        ("comment=any&priority=none", "a", "b"),
+    ],
+)
+def test_notes_table_filters_priority_and_comment(client, filter_notes, query, must_in, must_out):
+    # slug だけ見れば足りるので ?fields=slug で projection をサーバ側に寄せる
+    r = client.get(f"/notes/table?{query}&fields=slug", headers={"accept": "application/json"})
     assert r.status_code == 200
-    slugs = [n["slug"] for n in r.json()["notes"]]
-    assert b in slugs and a not in slugs
+    slugs = set(r.json()["slugs"])  # 1回だけ走査して、以降の in / not in は O(1)
+    assert filter_notes[must_in] in slugs and filter_notes[must_out] not in slugs
+
+
+def test_notes_table_fields_slug_matches_full_rows(client, filter_notes):
+    """Contract: ?fields=slug は同じ filter / 並び順の slug だけを返す（不正な fields は 400）"""
+    headers = {"accept": "application/json"}
+    full = client.get("/notes/table?comment=any", headers=headers)
+    projected = client.get("/notes/table?comment=any&fields=slug", headers=headers)
+    assert full.status_code == 200 and projected.status_code == 200
+    assert projected.json() == {"slugs": [n["slug"] for n in full.json()["notes"]]}
+
+    r = client.get("/notes/table?fields=status", headers=headers)
+    assert r.status_code == 400
+
 
-    # priority=none -> must include a, exclude b
-    r = client.get("/notes/table?priority=none", headers={"accept": "application/json"})
+def test_notes_table_orders_null_priority_first_then_priority_asc(client, tmp_path, delete_notes):
+    slugs = {"ord_none": None, "ord_p2": 2, "ord_p1": 1}
+    delete_notes(*slugs)
+    for s in slugs:
+        (tmp_path / f"{s}.py").write_text(f"# NOTE(vNext): {s}\n", encoding="utf-8")
+
+    r = client.post("/scan?full=0", json={"root": str(tmp_path)})
     assert r.status_code == 200
-    slugs = [n["slug"] for n in r.json()["notes"]]
-    assert a in slugs and b not in slugs
+    for s, p in slugs.items():
+        if p is not None:
+            assert client.patch(f"/notes/{s}", json={"priority": p}).status_code == 200
 
-    # combined -> must include a, exclude b
-    r = client.get("/notes/table?comment=any&priority=none", headers={"accept": "application/json"})
+    r = client.get("/notes/table", headers={"accept": "application/json"})
     assert r.status_code == 200
-    slugs = [n["slug"] for n in r.json()["notes"]]
-    assert a in slugs and b not in slugs
+    order = [n["slug"] for n in r.json()["notes"] if n["slug"] in slugs]
+    assert order == ["ord_none", "ord_p1", "ord_p2"]
+    assert all(n["evidence_count"] == 1 for n in r.json()["notes"] if n["slug"] in slugs)
+
+
+def test_notes_table_vary_accept_once_for_html_and_json(client):
+    for accept in ("application/json", "text/html"):
+        r = client.get("/notes/table", headers={"accept": accept})
+        assert r.status_code == 200
+        tokens = [t.strip().lower() for t in r.headers.get("vary", "").split(",")]
+        assert tokens.count("accept") == 1
+
+
+def test_notes_table_large_html_is_streamed_with_same_headers(client, delete_notes):
+    import render
+
+    slugs = [f"bulk_{i:04d}" for i in range(render.NOTES_TABLE_CHUNK_ROWS + 20)]
+    with db_conn() as con:
+        con.executemany(
+            "INSERT OR IGNORE INTO notes (slug, status, created_at, updated_at) VALUES (?, 'open', 'x', 'x')",
+            [(s,) for s in slugs],
+        )
+
+    try:
+        r = client.get("/notes/table", headers={"accept": "text/html"})
+        assert r.status_code == 200
+        assert r.headers["content-type"] == "text/html; charset=utf-8"
+        assert r.headers.get("x-content-type-options") == "nosniff"
+        tokens = [t.strip().lower() for t in r.headers.get("vary", "").split(",")]
+        assert tokens.count("accept") == 1
+        assert r.text.rstrip().endswith("</html>")
+        assert all(f'<a href="/notes/{s}">{s}</a>' in r.text for s in slugs)
+    finally:
+        delete_notes(*slugs)